@@ -1,11 +1,26 @@
+import warnings
+from math import sqrt
+from datetime import datetime, timedelta
+from operator import itemgetter
+from itertools import izip
+from collections import namedtuple
+
+import numpy as np
 from flask import url_for
+from pymongo import UpdateOne
 
-from collections import namedtuple
+from .util import chunks
 
 
 _Anomaly = namedtuple('Anomaly', ['app_id', 'name', 'field'])
 
 
+# Sources of docs in `anomalies` collection, each one replaces
+# or updates its own docs only
+BATCH_SOURCE = 'batch'
+SCORER_SOURCE = 'scorer'
+
+
 class Anomaly(_Anomaly):
     @property
     def url(self):
@@ -13,3 +28,369 @@ class Anomaly(_Anomaly):
                        app_id=self.app_id, name=self.name, _external=True)
 
 
+# Coefficients of rational approximations of normal quantile function
+# (P. J. Acklam), relative error is less than 1.15e-9
+_NORM_A = (-3.969683028665376e+01, 2.209460984245205e+02,
+           -2.759285104469687e+02, 1.383577518672690e+02,
+           -3.066479806614716e+01, 2.506628277459239e+00)
+_NORM_B = (-5.447609879822406e+01, 1.615858368580409e+02,
+           -1.556989798598866e+02, 6.680131188771972e+01,
+           -1.328068155288572e+01, 1.0)
+_NORM_C = (-7.784894002430293e-03, -3.223964580411365e-01,
+           -2.400758277161838e+00, -2.549732539343734e+00,
+           4.374664141464968e+00, 2.938163982698783e+00)
+_NORM_D = (7.784695709041462e-03, 3.224671290700398e-01,
+           2.445134137142996e+00, 3.754408661907416e+00, 1.0)
+_NORM_P_LOW = 0.02425
+
+
+def norm_ppf(p):
+    """ Quantile function of standard normal distribution """
+    p = np.asarray(p, dtype=float)
+    x = np.empty_like(p)
+    low = p < _NORM_P_LOW
+    high = p > 1 - _NORM_P_LOW
+    central = ~(low | high)
+
+    q = p[central] - 0.5
+    r = q * q
+    x[central] = np.polyval(_NORM_A, r) * q / np.polyval(_NORM_B, r)
+    q = np.sqrt(-2 * np.log(p[low]))
+    x[low] = np.polyval(_NORM_C, q) / np.polyval(_NORM_D, q)
+    q = np.sqrt(-2 * np.log(1 - p[high]))
+    x[high] = -np.polyval(_NORM_C, q) / np.polyval(_NORM_D, q)
+    return x
+
+
+def t_ppf(p, df):
+    """
+    Quantile function of Student's t-distribution, Cornish-Fisher
+    expansion by normal quantile (Abramowitz and Stegun 26.7.5).
+    Accurate for degrees of freedom of tens and more.
+    """
+    z = norm_ppf(p)
+    df = np.asarray(df, dtype=float)
+    z2 = z * z
+    g1 = (z2 + 1) * z / 4
+    g2 = ((5 * z2 + 16) * z2 + 3) * z / 96
+    g3 = (((3 * z2 + 19) * z2 + 17) * z2 - 15) * z / 384
+    g4 = ((((79 * z2 + 776) * z2 + 1482) * z2 - 1920) * z2 - 945) * z
+    g4 /= 92160
+    return z + (g1 + (g2 + (g3 + g4 / df) / df) / df) / df
+
+
+def interpolate_gaps(values):
+    """
+    Linearly interpolate missing (NaN) values between known ones
+    in each row of 2d array. Leading and trailing NaNs are kept.
+    """
+    values = values.copy()
+    positions = np.arange(values.shape[1])
+    for row in values:
+        known = ~np.isnan(row)
+        if known.sum() < 2:
+            continue
+        first, last = np.flatnonzero(known)[[0, -1]]
+        gaps = ~known
+        gaps[:first] = gaps[last:] = False
+        row[gaps] = np.interp(positions[gaps], positions[known], row[known])
+    return values
+
+
+def seasonal_residuals(values, period):
+    """
+    Remove median and seasonal component from each row of 2d array.
+    Seasonal component is a median of each phase of period (columns
+    with the same index modulo `period` are of the same phase).
+    """
+    rows, cols = values.shape
+    median = np.nanmedian(values, axis=1)[:, np.newaxis]
+    detrended = values - median
+    cycles = -(-cols // period)
+    padded = np.full((rows, cycles * period), np.nan)
+    padded[:, :cols] = detrended
+    seasonal = np.nanmedian(padded.reshape(rows, cycles, period), axis=1)
+    seasonal -= np.nanmean(seasonal, axis=1)[:, np.newaxis]
+    seasonal = np.tile(seasonal, cycles)[:, :cols]
+    return detrended - seasonal
+
+
+def esd_test(residuals, max_anoms=0.02, alpha=0.01):
+    """
+    Generalized ESD test with median and MAD on each row of 2d array
+    (positive direction). Return boolean mask of anomalies.
+
+    Parameters:
+      - 'residuals' -- 2d array, NaN values are ignored
+      - 'max_anoms' -- maximum share of anomalies in each row
+      - 'alpha' -- level of statistical significance
+    """
+    data = residuals.copy()
+    num_rows = len(data)
+    row_indexes = np.arange(num_rows)
+    n = (~np.isnan(data)).sum(axis=1)
+    max_k = (max_anoms * n).astype(int)
+    candidates = np.zeros((num_rows, max_k.max() if num_rows else 0), int)
+    num_anoms = np.zeros(num_rows, int)
+    running = n > 2
+    for i in xrange(1, candidates.shape[1] + 1):
+        running &= (i <= max_k) & (n - i - 1 > 0)
+        if not running.any():
+            break
+        median = np.nanmedian(data, axis=1)
+        deviations = data - median[:, np.newaxis]
+        mad = 1.4826 * np.nanmedian(np.abs(deviations), axis=1)
+        # Test stops for rows without variance
+        running &= mad > 0
+        deviations[np.isnan(deviations)] = -np.inf
+        index = deviations.argmax(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stat = deviations[row_indexes, index] / mad
+            p = 1 - alpha / (n - i + 1)
+            t = t_ppf(p, np.maximum(n - i - 1, 1))
+            critical = t * (n - i) / np.sqrt((n - i - 1 + t * t) *
+                                             (n - i + 1))
+        candidates[:, i - 1] = index
+        num_anoms[running & (stat > critical)] = i
+        data[row_indexes[running], index[running]] = np.nan
+
+    mask = np.zeros(residuals.shape, bool)
+    for row, k in enumerate(num_anoms):
+        mask[row, candidates[row, :k]] = True
+    return mask
+
+
+def detect_anomalies(values, period=24, max_anoms=0.02, alpha=0.01):
+    """
+    Seasonal hybrid ESD test on each row of 2d array of equally spaced
+    values. Rows with less than two periods of known values are
+    skipped. Return boolean mask of anomalies.
+    """
+    with warnings.catch_warnings():
+        # Median of rows without values
+        warnings.simplefilter('ignore', RuntimeWarning)
+        values = interpolate_gaps(values)
+        valid = (~np.isnan(values)).sum(axis=1) >= 2 * period
+        mask = np.zeros(values.shape, bool)
+        if valid.any():
+            residuals = seasonal_residuals(values[valid], period)
+            mask[valid] = esd_test(residuals, max_anoms, alpha)
+    return mask
+
+
+def _detect_anomalies_star(args):
+    return detect_anomalies(*args)
+
+
+def load_series(counter, app_id, start, end, field='real_time'):
+    """
+    Return names and 2d array of average `field` value for each name
+    and interval of counter in (`start`, `end`] range.
+    Intervals without requests are NaN.
+    """
+    interval = timedelta(minutes=counter.interval)
+    num_of_cols = int((end - start).total_seconds() //
+                      interval.total_seconds())
+    rows = {}
+    for doc in counter.iter_docs(start, end, query={'app_id': app_id}):
+        col = int((doc['date'] - start).total_seconds() //
+                  interval.total_seconds()) - 1
+        if not 0 <= col < num_of_cols:
+            continue
+        row = rows.get(doc['name'])
+        if row is None:
+            row = rows[doc['name']] = np.full(num_of_cols, np.nan)
+        number = doc.get('NUMBER')
+        value = doc.get(field)
+        if number and value and number > 0 and value > 0:
+            row[col] = float(value) / number
+    names = sorted(rows)
+    values = np.array([rows[name] for name in names]).reshape(
+        len(names), num_of_cols)
+    return names, values
+
+
+def find_app_anomalies(counter, app_id, end, hours=1008, only_last=24,
+                       max_anoms=0.02, alpha=0.01, pool=None,
+                       chunk_size=500):
+    """
+    Return dict of names and lists of dates of app anomalies.
+
+    Parameters:
+      - 'counter' -- periodic counter docs are read from
+      - 'end' -- datetime to check docs till
+      - 'hours' -- hours of docs to check, each name is checked on them
+      - 'only_last' -- hours, anomalies of which are returned
+      - 'max_anoms', 'alpha' -- parameters of ESD test
+      - 'pool' -- pool of processes checking chunks of `chunk_size` names
+    """
+    start = end - timedelta(hours=hours)
+    names, values = load_series(counter, app_id, start, end)
+    # Number of intervals in a day
+    period = 24 * 60 // counter.interval
+    jobs = [(values[i:i + chunk_size], period, max_anoms, alpha)
+            for i in xrange(0, len(names), chunk_size)]
+    if not jobs:
+        return {}
+    if pool is not None:
+        results = pool.map(_detect_anomalies_star, jobs)
+    else:
+        results = map(_detect_anomalies_star, jobs)
+    mask = np.vstack(results)
+
+    interval = timedelta(minutes=counter.interval)
+    check_from = end - timedelta(hours=only_last)
+    anomalies = {}
+    for name, row in zip(names, mask):
+        dates = [start + interval * (col + 1) for col in np.flatnonzero(row)]
+        dates = [date for date in dates if date > check_from]
+        if dates:
+            anomalies[name] = dates
+    return anomalies
+
+
+class AnomalyScorer(object):
+    """
+    Online anomaly detection of periodic counter docs. For each
+    (app_id, name, field) exponentially weighted mean and variance are
+    kept in redis for all values and for each hour of week. Value of
+    every stored doc is compared with them and then added to them.
+    Dates of anomalies are added to `anomalies` collection into docs
+    with `SCORER_SOURCE` source.
+
+    Parameters:
+      - 'redis_db' -- redis db instance
+      - 'redis_prefix' -- prefix used in each redis key
+      - 'collection' -- mongo collection of anomalies
+      - 'fields' -- fields to check. NUMBER is checked as is,
+      other fields as average per request.
+      - 'threshold' -- number of standard deviations, which value has
+      to exceed mean by to be anomaly
+      - 'alpha' -- weight of new value in stats of all values
+      - 'seasonal_alpha' -- weight of new value in hour of week stats
+    """
+
+    # Numbers of values stats have to be made of to check values
+    MIN_SAMPLES = 24
+    MIN_SEASONAL_SAMPLES = 3
+    # Value must exceed mean by this share at least
+    MIN_CHANGE = 0.2
+    STATS_TTL = 5 * 7 * 24 * 3600
+    KEEP_ANOMALIES_DAYS = 7
+    CHUNK_SIZE = 1000
+
+    key_format = '%(prefix)s,scores,%(app_id)s,%(name)s'
+
+    def __init__(self, redis_db, redis_prefix, collection, fields,
+                 threshold=4.0, alpha=0.05, seasonal_alpha=0.2):
+        self.redis_db = redis_db
+        self.prefix = redis_prefix
+        self.collection = collection
+        self.fields = fields
+        self.threshold = threshold
+        self.alpha = alpha
+        self.seasonal_alpha = seasonal_alpha
+
+    def _get_value(self, doc, field):
+        value = doc.get(field)
+        if value is None:
+            return None
+        if field == 'NUMBER':
+            return float(value)
+        return float(value) / doc['NUMBER']
+
+    def _is_anomaly(self, stats, value, min_samples):
+        if stats is None or stats[2] < min_samples:
+            return None
+        mean, var, _ = stats
+        return (value > mean + self.threshold * sqrt(var) and
+                value > mean * (1 + self.MIN_CHANGE))
+
+    def _add_value(self, stats, value, alpha):
+        if stats is None:
+            return value, 0.0, 1
+        mean, var, count = stats
+        diff = value - mean
+        incr = alpha * diff
+        return mean + incr, (1 - alpha) * (var + diff * incr), count + 1
+
+    def score(self, counter, docs):
+        """
+        Check values of `docs` stored by `counter` and update stats.
+        """
+        interval = timedelta(minutes=counter.interval)
+        for docs_chunk in chunks(sorted(docs, key=itemgetter('date')),
+                                 self.CHUNK_SIZE):
+            values = []
+            for doc in docs_chunk:
+                if not doc.get('NUMBER') or doc['NUMBER'] <= 0:
+                    continue
+                key = self.key_format % dict(prefix=self.prefix,
+                                             app_id=doc['app_id'],
+                                             name=doc['name'])
+                start = doc['date'] - interval
+                hour_of_week = start.weekday() * 24 + start.hour
+                for field in self.fields:
+                    value = self._get_value(doc, field)
+                    if value is None:
+                        continue
+                    values.append((doc, key, '%s:all' % field,
+                                   '%s:%u' % (field, hour_of_week), value))
+            if not values:
+                continue
+
+            # Read stats of all series at once
+            stats_fields = {}
+            for _, key, all_field, hour_field, _ in values:
+                stats_fields.setdefault(key, set()).update((all_field,
+                                                            hour_field))
+            pl = self.redis_db.pipeline(transaction=False)
+            for key, fields in stats_fields.iteritems():
+                pl.hmget(key, list(fields))
+            stats = {}
+            for (key, fields), res in izip(stats_fields.iteritems(),
+                                           pl.execute()):
+                for field, value in izip(fields, res):
+                    if value is not None:
+                        value = map(float, value.split(','))
+                        stats[key, field] = value[0], value[1], int(value[2])
+
+            anomalies = {}
+            for doc, key, all_field, hour_field, value in values:
+                all_stats = stats.get((key, all_field))
+                hour_stats = stats.get((key, hour_field))
+                # Hour of week stats are used, when there are enough of them
+                is_anomaly = self._is_anomaly(hour_stats, value,
+                                              self.MIN_SEASONAL_SAMPLES)
+                if is_anomaly is None:
+                    is_anomaly = self._is_anomaly(all_stats, value,
+                                                  self.MIN_SAMPLES)
+                if is_anomaly:
+                    anomalies.setdefault((doc['app_id'], doc['name']),
+                                         set()).add(doc['date'])
+                stats[key, all_field] = self._add_value(all_stats, value,
+                                                        self.alpha)
+                stats[key, hour_field] = self._add_value(
+                    hour_stats, value, self.seasonal_alpha)
+
+            pl = self.redis_db.pipeline(transaction=False)
+            for key, fields in stats_fields.iteritems():
+                pl.hmset(key, {field: '%r,%r,%u' % stats[key, field]
+                               for field in fields
+                               if (key, field) in stats})
+                pl.expire(key, self.STATS_TTL)
+            pl.execute()
+            if anomalies:
+                self._add_anomalies(anomalies)
+
+    def _add_anomalies(self, anomalies):
+        oldest_date = datetime.utcnow() - timedelta(
+            days=self.KEEP_ANOMALIES_DAYS)
+        requests = []
+        for (app_id, name), dates in anomalies.iteritems():
+            spec = {'app_id': app_id, 'name': name, 'source': SCORER_SOURCE}
+            requests.append(UpdateOne(spec, {'$pull': {
+                'anomalies': {'$lt': oldest_date}}}))
+            requests.append(UpdateOne(spec, {'$addToSet': {
+                'anomalies': {'$each': sorted(dates)}}}, upsert=True))
+        self.collection.bulk_write(requests, ordered=False)
@@ -1,5 +1,8 @@
 # encoding: utf-8
+import re
+import json
 import logging
+from hashlib import md5
 from copy import deepcopy
 from os.path import expanduser
 from operator import itemgetter
@@ -11,12 +14,22 @@ import cantal
 from redis.client import StrictRedis, StrictPipeline
 from flask import abort, Blueprint, Flask, redirect
 from flask import render_template, request, url_for
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo import MongoClient, DESCENDING
 from werkzeug.wsgi import ClosingIterator
 from cantal_tools.flask import FlaskMixin
 
-from .util import current_url, get_chart_info
-from .counter import RollingCounter, PeriodicCounter
+from .util import current_url, get_chart_info, get_chart_counter
+from .util import make_columnar_series, gzip_response, make_flat_doc
+from .cache import ChartCache
+from .codec import decode_stats, JSON_CONTENT_TYPE, COMPACT_CONTENT_TYPE
+from .coalescer import StatsCoalescer
+from .leaderboard import Leaderboards
+from .search import NamesIndex
+from .counter import RollingCounter, RingRollingCounter, PeriodicCounter
+from .counter import EpochPeriodicCounter, RollupPeriodicCounter
+from .counter import CounterGroup, KeyInterner, check_stats
+from .cardinality import CardinalityGuard
+from .anomaly import AnomalyScorer
 from .filters import json_filter, time_filter, count_filter, default_filter
 from .filters import pretty_hours_filter
 from .metrics import request_tracking_middleware, patch_redis, patch_mongo
@@ -61,76 +74,180 @@ redis_db = StrictRedis(host=app.config['REDIS_HOST'],
                        port=app.config['REDIS_PORT'],
                        db=app.config['REDIS_DB'])
 REDIS_PREFIX = 'appstats'
+ROLLING_COUNTER_LUA = app.config['ROLLING_COUNTER_LUA']
+PERIODIC_BUCKETED_DOCS = app.config['PERIODIC_BUCKETED_DOCS']
+HISTOGRAM_FIELDS = app.config['HISTOGRAM_FIELDS']
+if app.config['ROLLING_COUNTER_RING']:
+    rolling_counter_cls = RingRollingCounter
+else:
+    rolling_counter_cls = RollingCounter
+if app.config['PERIODIC_COUNTER_EPOCHS']:
+    periodic_counter_cls = EpochPeriodicCounter
+else:
+    periodic_counter_cls = PeriodicCounter
+if app.config['COMPACT_KEYS']:
+    key_interner = KeyInterner(redis_db, REDIS_PREFIX)
+else:
+    key_interner = None
+if app.config['CARDINALITY_GUARD']:
+    apps_cardinality_guard = CardinalityGuard(
+        redis_db, REDIS_PREFIX, 'apps', app.config['CARDINALITY_MAX_NAMES'],
+        other_name=app.config['CARDINALITY_OTHER_NAME']
+    )
+    tasks_cardinality_guard = CardinalityGuard(
+        redis_db, REDIS_PREFIX, 'tasks', app.config['CARDINALITY_MAX_NAMES'],
+        other_name=app.config['CARDINALITY_OTHER_NAME']
+    )
+else:
+    apps_cardinality_guard = tasks_cardinality_guard = None
 
 mongo_conn = MongoClient(host=app.config['MONGO_URI'], socketTimeoutMS=30000,
                          connectTimeoutMs=60000, connect=False)
 mongo_db = mongo_conn[app.config['MONGO_DB_NAME']]
 
+
+def cascade_rollups(periodic_counters, stats):
+    """
+    Replace all periodic counters, except the most accurate one, by
+    counters rolled up from the previous (more accurate) counter.
+    """
+    counters = periodic_counters[:1]
+    for counter in periodic_counters[1:]:
+        counters.append(RollupPeriodicCounter(
+            divider=counter.divider, redis_db=redis_db,
+            mongo_db=mongo_db, fields=fields_keys,
+            redis_prefix=REDIS_PREFIX, period=counter.period, stats=stats,
+            interner=key_interner, bucketed=PERIODIC_BUCKETED_DOCS,
+            histograms=HISTOGRAM_FIELDS, source=counters[-1]
+        ))
+    return counters
+
+
+def fed_counters(counters, leaderboards=None):
+    """
+    Return counters, which have to be fed with incoming stats,
+    including `leaderboards` if they are used.
+    """
+    fed = [counter for counter in counters
+           if not isinstance(counter, RollupPeriodicCounter)]
+    if leaderboards is not None:
+        fed.append(leaderboards)
+    return fed
+
+
+if app.config['LEADERBOARDS']:
+    visible_keys = [f['key'] for f in visible_fields]
+    apps_leaderboards = Leaderboards(redis_db, REDIS_PREFIX, 'apps',
+                                     visible_keys)
+    tasks_leaderboards = Leaderboards(redis_db, REDIS_PREFIX, 'tasks',
+                                      visible_keys)
+else:
+    apps_leaderboards = tasks_leaderboards = None
+
 ########################### Application Counters ##############################
 
 # Applications statistics rolling counters
-apps_last_hour_counter = RollingCounter(db=redis_db, fields=fields_keys,
-                                        redis_prefix=REDIS_PREFIX)
-apps_last_day_counter = RollingCounter(db=redis_db, fields=fields_keys,
-                                       redis_prefix=REDIS_PREFIX,
-                                       interval=86400, secs_per_part=3600)
+apps_last_hour_counter = rolling_counter_cls(db=redis_db, fields=fields_keys,
+                                             redis_prefix=REDIS_PREFIX,
+                                             use_lua=ROLLING_COUNTER_LUA,
+                                             interner=key_interner)
+apps_last_day_counter = rolling_counter_cls(db=redis_db, fields=fields_keys,
+                                            redis_prefix=REDIS_PREFIX,
+                                            interval=86400, secs_per_part=3600,
+                                            use_lua=ROLLING_COUNTER_LUA,
+                                            interner=key_interner)
 apps_rolling_counters = [apps_last_hour_counter, apps_last_day_counter]
 
 # Applications statistics periodic counters
 apps_periodic_counters = [
     # Very accurate, 6 hours counter with 1 min intervals
-    PeriodicCounter(
+    periodic_counter_cls(
         divider=60, redis_db=redis_db,
         mongo_db=mongo_db, fields=fields_keys,
-        redis_prefix=REDIS_PREFIX, period=6
+        redis_prefix=REDIS_PREFIX, period=6,
+        interner=key_interner,
+        bucketed=PERIODIC_BUCKETED_DOCS,
+        histograms=HISTOGRAM_FIELDS
     ),
     # Middle accurate, 6 days(144 hours) counter with 10 min intervals
-    PeriodicCounter(
+    periodic_counter_cls(
         divider=6, redis_db=redis_db,
         mongo_db=mongo_db, fields=fields_keys,
-        redis_prefix=REDIS_PREFIX, period=144
+        redis_prefix=REDIS_PREFIX, period=144,
+        interner=key_interner,
+        bucketed=PERIODIC_BUCKETED_DOCS,
+        histograms=HISTOGRAM_FIELDS
     ),
     # Low accurate, half-year(182 * 24 = 4368) counter with 60 min intervals
-    PeriodicCounter(
+    periodic_counter_cls(
         divider=1, redis_db=redis_db,
         mongo_db=mongo_db, fields=fields_keys,
-        redis_prefix=REDIS_PREFIX, period=4368
+        redis_prefix=REDIS_PREFIX, period=4368,
+        interner=key_interner,
+        bucketed=PERIODIC_BUCKETED_DOCS,
+        histograms=HISTOGRAM_FIELDS
     )
 ]
 apps_periodic_counters = sorted(apps_periodic_counters, key=lambda c: c.period)
+if app.config['CASCADE_ROLLUPS']:
+    apps_periodic_counters = cascade_rollups(apps_periodic_counters, 'apps')
+if app.config['ANOMALY_SCORING']:
+    # Anomalies are shown with hour precision
+    apps_periodic_counters[-1].scorer = AnomalyScorer(
+        redis_db, '%s_apps' % REDIS_PREFIX, mongo_db.anomalies,
+        app.config['ANOMALY_SCORING_FIELDS'],
+        threshold=app.config['ANOMALY_SCORING_THRESHOLD']
+    )
 
 # All applications counters
 apps_counters = apps_rolling_counters + apps_periodic_counters
+apps_counter_group = CounterGroup(redis_db, fed_counters(apps_counters,
+                                                       apps_leaderboards),
+                                  interner=key_interner,
+                                  guard=apps_cardinality_guard)
 
 ###############################################################################
 
 ############################## Tasks Counters #################################
 # Tasks statistics rolling counters
-tasks_last_hour_counter = RollingCounter(db=redis_db, fields=fields_keys,
-                                         redis_prefix=REDIS_PREFIX,
-                                         stats='tasks')
-tasks_last_day_counter = RollingCounter(db=redis_db, fields=fields_keys,
-                                        redis_prefix=REDIS_PREFIX,
-                                        stats='tasks', interval=86400,
-                                        secs_per_part=3600)
+tasks_last_hour_counter = rolling_counter_cls(db=redis_db, fields=fields_keys,
+                                              redis_prefix=REDIS_PREFIX,
+                                              stats='tasks',
+                                              use_lua=ROLLING_COUNTER_LUA,
+                                              interner=key_interner)
+tasks_last_day_counter = rolling_counter_cls(db=redis_db, fields=fields_keys,
+                                             redis_prefix=REDIS_PREFIX,
+                                             stats='tasks', interval=86400,
+                                             secs_per_part=3600,
+                                             use_lua=ROLLING_COUNTER_LUA,
+                                             interner=key_interner)
 tasks_rolling_counters = [tasks_last_hour_counter, tasks_last_day_counter]
 
 # Tasks statistics periodic counters
 tasks_periodic_counters = [
-    PeriodicCounter(
+    periodic_counter_cls(
         divider=60, redis_db=redis_db,
         mongo_db=mongo_db, fields=fields_keys,
-        redis_prefix=REDIS_PREFIX, period=6, stats='tasks'
+        redis_prefix=REDIS_PREFIX, period=6, stats='tasks',
+        interner=key_interner,
+        bucketed=PERIODIC_BUCKETED_DOCS,
+        histograms=HISTOGRAM_FIELDS
     ),
-    PeriodicCounter(
+    periodic_counter_cls(
         divider=6, redis_db=redis_db,
         mongo_db=mongo_db, fields=fields_keys,
-        redis_prefix=REDIS_PREFIX, period=144, stats='tasks'
+        redis_prefix=REDIS_PREFIX, period=144, stats='tasks',
+        interner=key_interner,
+        bucketed=PERIODIC_BUCKETED_DOCS,
+        histograms=HISTOGRAM_FIELDS
     ),
-    PeriodicCounter(
+    periodic_counter_cls(
         divider=1, redis_db=redis_db,
         mongo_db=mongo_db, fields=fields_keys,
-        redis_prefix=REDIS_PREFIX, period=4368, stats='tasks'
+        redis_prefix=REDIS_PREFIX, period=4368, stats='tasks',
+        interner=key_interner,
+        bucketed=PERIODIC_BUCKETED_DOCS,
+        histograms=HISTOGRAM_FIELDS
     )
 ]
 # Very accurate, 6 hours counter with 1 min intervals
@@ -138,9 +255,23 @@ tasks_periodic_counters = [
 # Low accurate, half-year(182 * 24 = 4368) counter with 60 min intervals
 tasks_periodic_counters = sorted(tasks_periodic_counters,
                                  key=lambda c: c.period)
+if app.config['CASCADE_ROLLUPS']:
+    tasks_periodic_counters = cascade_rollups(tasks_periodic_counters, 'tasks')
 
 # All tasks counters
 tasks_counters = tasks_rolling_counters + tasks_periodic_counters
+tasks_counter_group = CounterGroup(redis_db, fed_counters(tasks_counters,
+                                                        tasks_leaderboards),
+                                   interner=key_interner,
+                                   guard=tasks_cardinality_guard)
+
+if app.config['NAMES_INDEX']:
+    apps_names_index = NamesIndex(redis_db, REDIS_PREFIX, 'apps',
+                                  interner=key_interner)
+    tasks_names_index = NamesIndex(redis_db, REDIS_PREFIX, 'tasks',
+                                   interner=key_interner)
+else:
+    apps_names_index = tasks_names_index = None
 
 ###############################################################################
 
@@ -165,30 +296,63 @@ def add_stats_middleware(wsgi_app):
         tasks_stats = environ.get('appstats.tasks_stats')
         if not (apps_stats or tasks_stats):
             return iterator
-        return ClosingIterator(iterator, lambda: add_stats(apps_stats,
-                                                           tasks_stats,
-                                                           apps_counters,
-                                                           tasks_counters))
+        if stats_coalescer:
+            return ClosingIterator(
+                iterator, lambda: coalesce_stats(apps_stats, tasks_stats))
+        return ClosingIterator(
+            iterator, lambda: add_stats(apps_stats, tasks_stats,
+                                        apps_counter_group,
+                                        tasks_counter_group))
     return inner
 app.wsgi_app = add_stats_middleware(app.wsgi_app)
 
 
-def add_stats(apps_stats, tasks_stats, apps_counters, tasks_counters):
+def set_default_number(stats):
+    for app_id in stats:
+        for name, counts in stats[app_id].iteritems():
+            counts.setdefault('NUMBER', 1)
+
+
+def add_stats(apps_stats, tasks_stats,
+              apps_counter_group, tasks_counter_group):
     if apps_stats:
         log.debug("Adding new apps_stats: \n %s", apps_stats)
-        for app_id in apps_stats:
-            for name, counts in apps_stats[app_id].iteritems():
-                counts.setdefault('NUMBER', 1)
-        for counter in apps_counters:
-            counter.incrby_bulk(apps_stats)
+        set_default_number(apps_stats)
+        apps_counter_group.incrby_bulk(apps_stats)
 
     if tasks_stats:
         log.debug("Adding new tasks_stats: \n %s", tasks_stats)
-        for app_id in tasks_stats:
-            for name, counts in tasks_stats[app_id].iteritems():
-                counts.setdefault('NUMBER', 1)
-        for counter in tasks_counters:
-            counter.incrby_bulk(tasks_stats)
+        set_default_number(tasks_stats)
+        tasks_counter_group.incrby_bulk(tasks_stats)
+
+
+def coalesce_stats(apps_stats, tasks_stats):
+    # Default number has to be set for each posted stats before merging
+    if apps_stats:
+        set_default_number(apps_stats)
+    if tasks_stats:
+        set_default_number(tasks_stats)
+    stats_coalescer.add(apps_stats, tasks_stats)
+
+
+if app.config['COALESCE_STATS']:
+    stats_coalescer = StatsCoalescer(
+        lambda apps_stats, tasks_stats: add_stats(apps_stats, tasks_stats,
+                                                  apps_counter_group,
+                                                  tasks_counter_group),
+        interval=app.config['COALESCE_INTERVAL'],
+        max_entries=app.config['COALESCE_MAX_ENTRIES'],
+        queue_size=app.config['COALESCE_QUEUE_SIZE'],
+    )
+else:
+    stats_coalescer = None
+
+chart_cache = ChartCache(
+    size=app.config['CHART_CACHE_SIZE'],
+    redis_db=redis_db if app.config['CHART_CACHE_REDIS'] else None,
+    redis_prefix=REDIS_PREFIX,
+    ttl=app.config['CHART_CACHE_TTL'],
+)
 
 
 @app.route('/')
@@ -201,10 +365,31 @@ def add_apps_stats_help():
     return render_template('add_page_help.jinja')
 
 
+def get_posted_stats():
+    """
+    Return stats posted as JSON or in the compact format, both can be
+    gzipped. Return None for other content types.
+    Abort with 400 if stats are malformed.
+    """
+    if request.mimetype not in (JSON_CONTENT_TYPE, COMPACT_CONTENT_TYPE):
+        return None
+    try:
+        stats = decode_stats(request.data, request.mimetype,
+                             request.headers.get('Content-Encoding'))
+        # Stats are checked before they are merged with stats of other
+        # requests (or written after response), so only this request fails
+        if stats:
+            check_stats(stats)
+    except ValueError as e:
+        log.warning("Failed to decode posted stats: {}".format(e))
+        abort(400)
+    return stats
+
+
 @app.route('/add/', methods=['POST'])  # for back capability
 @app.route('/add/apps_stats', methods=['POST'])
 def add_apps_stats():
-    apps_stats = request.json
+    apps_stats = get_posted_stats()
     request.environ['appstats.apps_stats'] = apps_stats
     return 'ok'
 
@@ -216,7 +401,7 @@ def add_tasks_stats_help():
 
 @app.route('/add/tasks_stats', methods=['POST'])
 def add_tasks_stats():
-    tasks_stats = request.json
+    tasks_stats = get_posted_stats()
     request.environ['appstats.tasks_stats'] = tasks_stats
     return 'ok'
 
@@ -235,9 +420,6 @@ def add_event_page():
                  'descr': event['descr']} for event in events]
         log.debug("Adding new events: \n %s", docs)
         mongo_db.appstats_events.insert(docs)
-    mongo_db.appstats_events.ensure_index([('date', ASCENDING),
-                                           ('app_id', ASCENDING)],
-                                          ttl=3600)
     return 'ok'
 
 
@@ -310,6 +492,45 @@ def add_nav_list():
     return dict(nav_list=nav_list)
 
 
+def add_search_query(query, search_term, names_index):
+    names = None
+    if names_index is not None:
+        names = names_index.search(query['app_id'], search_term)
+    query.setdefault('name', {})
+    if names is None:
+        query['name']['$regex'] = re.escape(search_term)
+    elif '$in' in query['name']:
+        query['name']['$in'] = list(names.intersection(query['name']['$in']))
+    else:
+        query['name']['$in'] = list(names)
+
+
+def find_top_docs(collection, leaderboards, query, sort_by_field,
+                  sort_by_period, rows_limit, rolling_counters):
+    if sort_by_field == 'name':
+        docs = collection.find(query).sort('name')
+        return list(docs.limit(rows_limit))
+    sort_by = '%s_%s' % (sort_by_field, sort_by_period)
+    # Leaderboards contain all names of app, so filtered docs
+    # are sorted by mongo
+    if leaderboards is None or query.keys() != ['app_id']:
+        docs = collection.find(query).sort(sort_by, DESCENDING)
+        return list(docs.limit(rows_limit))
+    names = leaderboards.get_top(query['app_id'], sort_by, rows_limit)
+    if not names:
+        return []
+    # Rows are made of rolling counters, as leaderboards are fresher
+    # than cached docs
+    last_hour_counter, last_day_counter = rolling_counters
+    hour_counts = last_hour_counter.get_counts(query['app_id'], names)
+    day_counts = last_day_counter.get_counts(query['app_id'], names)
+    return [make_flat_doc(query['app_id'], name, hour, day,
+                          last_hour_counter.interval,
+                          last_day_counter.interval,
+                          last_hour_counter.fields)
+            for name, hour, day in zip(names, hour_counts, day_counts)]
+
+
 @stats_bp.route('/appstats', methods=['GET', 'POST'])
 def appstats(app_id):
     if request.method == 'POST':
@@ -341,17 +562,11 @@ def appstats(app_id):
         query.setdefault('name', {})
         query['name']['$in'] = list(anomalies)
     if search_term:
-        query.setdefault('name', {})
-        query['name']['$regex'] = '.*{}.*'.format(search_term)
+        add_search_query(query, search_term, apps_names_index)
 
-    docs = mongo_db.appstats_docs.find(query)
-
-    if sort_by_field == 'name':
-        docs = docs.sort('name')
-    else:
-        sort_by = '%s_%s' % (sort_by_field, sort_by_period)
-        docs = docs.sort(sort_by, DESCENDING)
-    docs = list(docs.limit(rows_limit))
+    docs = find_top_docs(mongo_db.appstats_docs, apps_leaderboards, query,
+                         sort_by_field, sort_by_period, rows_limit,
+                         apps_rolling_counters)
 
     return render_template('stats.jinja', sort_by_field=sort_by_field,
                            app_id=app_id, fields=visible_fields,
@@ -396,16 +611,10 @@ def tasks(app_id):
         query.setdefault('name', {})
         query['name']['$in'] = list(anomalies)
     if search_term:
-        query.setdefault('name', {})
-        query['name']['$regex'] = '.*{}.*'.format(search_term)
-    docs = mongo_db.appstats_tasks_docs.find(query)
-
-    if sort_by_field == 'name':
-        docs = docs.sort('name')
-    else:
-        sort_by = '%s_%s' % (sort_by_field, sort_by_period)
-        docs = docs.sort(sort_by, DESCENDING)
-    docs = list(docs.limit(rows_limit))
+        add_search_query(query, search_term, tasks_names_index)
+    docs = find_top_docs(mongo_db.appstats_tasks_docs, tasks_leaderboards,
+                         query, sort_by_field, sort_by_period, rows_limit,
+                         tasks_rolling_counters)
 
     return render_template('stats.jinja', sort_by_field=sort_by_field,
                            app_id=app_id, fields=visible_fields,
@@ -419,52 +628,96 @@ def tasks(app_id):
                            info_endpoint='.tasks_info')
 
 
-@stats_bp.route('/appstats/<name>')
-def apps_info(app_id, name):
+def get_info_hours():
     hours = request.args.get('hours', INFO_HOURS_OPTIONS[0], int)
     if hours not in INFO_HOURS_OPTIONS:
         hours = INFO_HOURS_OPTIONS[0]
+    return hours
 
-    num_data, time_data, anomalies_data = get_chart_info(
-        apps_periodic_counters, time_fields, app_id, name, hours, mongo_db.anomalies
-    )
 
+def get_anomalies_generation(anomalies_coll, app_id, name):
+    """
+    Return digest of anomaly dates of name, which changes whenever
+    anomalies are detected between rollups.
+    """
+    if anomalies_coll is None:
+        return None
+    docs = anomalies_coll.find({'app_id': app_id, 'name': name},
+                               {'anomalies': 1, '_id': 0})
+    dates = sorted(date for doc in docs for date in doc.get('anomalies', ()))
+    return md5(repr(dates)).hexdigest()
+
+
+def chart_series_response(periodic_counters, app_id, name,
+                          anomalies_coll=None):
+    hours = get_info_hours()
+    counter = get_chart_counter(periodic_counters, hours)
+    # Series change only when the chosen counter stores new docs
+    # or anomalies are found
+    etag = md5(repr((counter.collection.name, hours,
+                     counter.get_last_update(),
+                     get_anomalies_generation(anomalies_coll, app_id, name),
+                     app.config['CHART_MAX_POINTS']))).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        # Sets Vary header, as the full response does
+        return gzip_response(response)
+
+    num_data, time_data, anomalies_data, quantiles = get_chart_info(
+        periodic_counters, time_fields, app_id, name, hours,
+        anomalies_coll, cache=chart_cache
+    )
+    series = make_columnar_series(num_data, time_data, anomalies_data,
+                                  app.config['CHART_MAX_POINTS'])
+    # [label, [p50, p95, p99]] for time fields with histograms
+    series['quantiles'] = quantiles
     # Get all names from time_fields and use them as labels
-    time_labels = [f['name'] for f in time_fields]
+    series['labels'] = [f['name'] for f in time_fields]
+
+    response = app.response_class(json.dumps(series),
+                                  mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    return gzip_response(response)
+
 
+@stats_bp.route('/api/appstats/<name>/series')
+def apps_series(app_id, name):
+    return chart_series_response(apps_periodic_counters, app_id, name,
+                                 mongo_db.anomalies)
+
+
+@stats_bp.route('/api/tasks/<name>/series')
+def tasks_series(app_id, name):
+    return chart_series_response(tasks_periodic_counters, app_id, name)
+
+
+@stats_bp.route('/appstats/<name>')
+def apps_info(app_id, name):
+    hours = get_info_hours()
     doc = mongo_db.appstats_docs.find_one(
         {'app_id': app_id, 'name': name}) or {}
 
     return render_template('info_page.jinja', fields=visible_fields, doc=doc,
                            info_hours_options=INFO_HOURS_OPTIONS,
-                           num_data=num_data, name=name, hours=hours,
-                           time_labels=time_labels, time_data=time_data,
-                           search_action=url_for('.appstats'),
-                           anomalies_data=anomalies_data)
+                           name=name, hours=hours,
+                           series_url=url_for('.apps_series', name=name,
+                                              hours=hours),
+                           search_action=url_for('.appstats'))
 
 
 @stats_bp.route('/tasks/<name>')
 def tasks_info(app_id, name):
-    hours = request.args.get('hours', INFO_HOURS_OPTIONS[0], int)
-    if hours not in INFO_HOURS_OPTIONS:
-        hours = INFO_HOURS_OPTIONS[0]
-
-    num_data, time_data, anomalies_data = get_chart_info(
-        tasks_periodic_counters, time_fields, app_id, name, hours
-    )
-
-    # Get all names from time_fields and use them as labels
-    time_labels = [f['name'] for f in time_fields]
-
+    hours = get_info_hours()
     doc = mongo_db.appstats_tasks_docs.find_one(
         {'app_id': app_id, 'name': name}) or {}
 
     return render_template('info_page.jinja', fields=visible_fields, doc=doc,
                            info_hours_options=INFO_HOURS_OPTIONS,
-                           num_data=num_data, name=name, hours=hours,
-                           time_labels=time_labels, time_data=time_data,
-                           search_action=url_for('.tasks'),
-                           anomalies_data=anomalies_data)
+                           name=name, hours=hours,
+                           series_url=url_for('.tasks_series', name=name,
+                                              hours=hours),
+                           search_action=url_for('.tasks'))
 
 
 app.register_blueprint(stats_bp)
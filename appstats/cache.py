@@ -0,0 +1,77 @@
+# encoding: utf-8
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+
+log = logging.getLogger(__name__)
+
+
+class ChartCache(object):
+    """
+    Cache of chart series: in-process LRU with optional redis layer
+    shared between processes.
+    Keys are tuples, which have to change when cached data gets outdated
+    (e.g. contain the time of the latest rollup).
+
+    Parameters:
+      - 'size' -- number of entries kept in process
+      - 'redis_db' -- redis db instance to share entries through
+      - 'redis_prefix' -- prefix used in each redis key
+      - 'ttl' -- time in seconds to keep shared entries for
+    """
+
+    key_format = '%(prefix)s,chart_cache,%(key)s'
+
+    def __init__(self, size=256, redis_db=None, redis_prefix='appstats',
+                 ttl=3600):
+        self.size = size
+        self.redis_db = redis_db
+        self.prefix = redis_prefix
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _make_key(self, key):
+        key = u','.join(map(unicode, key)).encode('utf-8')
+        return self.key_format % dict(prefix=self.prefix, key=key)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                # Move entry to the end as the most recently used
+                self._entries[key] = value
+                return value
+        if self.redis_db is None:
+            return None
+        try:
+            value = self.redis_db.get(self._make_key(key))
+        except RedisError as e:
+            log.warning("Failed to get cached chart: {}".format(e))
+            return None
+        if value is None:
+            return None
+        value = json.loads(value)
+        self._set_local(key, value)
+        return value
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        if self.redis_db is None:
+            return
+        try:
+            self.redis_db.setex(self._make_key(key), self.ttl,
+                                json.dumps(value))
+        except RedisError as e:
+            log.warning("Failed to cache chart: {}".format(e))
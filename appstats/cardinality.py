@@ -0,0 +1,185 @@
+# encoding: utf-8
+from datetime import datetime
+from itertools import izip
+
+from .util import merge_stats
+
+
+class CardinalityGuard(object):
+    """
+    Bounds number of names each app_id gets counters for.
+    Distinct names of each day are estimated with a redis HyperLogLog.
+    When the estimate of app_id nears `max_names`, its heavy hitters are
+    tracked with a Space-Saving summary of `max_names` entries (sorted
+    set of counts and hash of errors), and stats of names, which can't
+    be told from the long tail, are counted under `other_name`.
+
+    Name is let through while the summary isn't full or when its
+    guaranteed count (count - error) reaches the smallest count kept,
+    i.e. it's surely more frequent than any name it could replace.
+    Summaries are started again every day, so names which stopped being
+    reported leave them.
+
+    Guard adds no round trips: its commands are queued into the pipeline
+    of `CounterGroup`, and their results decide about the next stats.
+    So a name of guarded app_id is counted under `other_name` until
+    the summary has let it through once.
+
+    Parameters:
+      - 'redis_db' -- redis db instance
+      - 'redis_prefix' -- prefix used in each redis key
+      - 'stats' -- name of statistics (apps or tasks)
+      - 'max_names' -- number of names tracked for each app_id
+      - 'other_name' -- name to count the long tail under
+    """
+
+    hll_key_format = '%(prefix)s,cardinality,%(stats)s,%(app_id)s,%(day)s,hll'
+    counts_key_format = ('%(prefix)s,cardinality,%(stats)s,%(app_id)s,'
+                         '%(day)s,counts')
+    errors_key_format = ('%(prefix)s,cardinality,%(stats)s,%(app_id)s,'
+                         '%(day)s,errors')
+
+    TTL = 24 * 3600
+    # App_id is guarded, when estimate of its names reaches this share
+    # of `max_names`, so the summary is filled before the limit
+    GUARD_SHARE = 0.8
+
+    # Update Space-Saving summary (counts in sorted set KEYS[1], errors
+    # in hash KEYS[2]) of size ARGV[1] with ARGV[3..] pairs of name and
+    # weight, return 1 for each name which is let through, 0 otherwise
+    update_script = """
+        local size = tonumber(ARGV[1])
+        local ttl = tonumber(ARGV[2])
+        local passed = {}
+        for i = 3, #ARGV, 2 do
+            local name = ARGV[i]
+            local weight = tonumber(ARGV[i + 1])
+            local count
+            local err = 0
+            if redis.call('ZSCORE', KEYS[1], name) then
+                count = tonumber(redis.call('ZINCRBY', KEYS[1], weight, name))
+                err = tonumber(redis.call('HGET', KEYS[2], name) or 0)
+            elseif redis.call('ZCARD', KEYS[1]) < size then
+                count = weight
+                redis.call('ZADD', KEYS[1], count, name)
+            else
+                -- Replace the least counted name, taking its count as error
+                local least = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+                redis.call('ZREM', KEYS[1], least[1])
+                redis.call('HDEL', KEYS[2], least[1])
+                err = tonumber(least[2])
+                count = err + weight
+                redis.call('ZADD', KEYS[1], count, name)
+                redis.call('HSET', KEYS[2], name, err)
+            end
+            local pass = 1
+            if redis.call('ZCARD', KEYS[1]) >= size then
+                local least = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+                if count - err < tonumber(least[2]) then
+                    pass = 0
+                end
+            end
+            passed[#passed + 1] = pass
+        end
+        redis.call('EXPIRE', KEYS[1], ttl)
+        redis.call('EXPIRE', KEYS[2], ttl)
+        return passed
+    """
+
+    def __init__(self, redis_db, redis_prefix, stats, max_names,
+                 other_name='__other__'):
+        self.db = redis_db
+        self.prefix = redis_prefix
+        self.stats = stats
+        self.max_names = max_names
+        self.other_name = other_name
+        self._day = None
+        # Names let through for each guarded app_id
+        self._passed = {}
+
+    def _get_day(self):
+        day = datetime.utcnow().strftime('%Y%m%d')
+        if day != self._day:
+            # Summaries of the new day are empty
+            self._day = day
+            self._passed = {}
+        return day
+
+    def _make_key(self, key_format, app_id, day):
+        return key_format % dict(prefix=self.prefix, stats=self.stats,
+                                 app_id=app_id, day=day)
+
+    def filter(self, stats):
+        """
+        Return copy of `stats` with counts of long tail names
+        of each guarded app_id summed up under `other_name`.
+        """
+        self._get_day()
+        filtered = {}
+        for app_id, names in stats.iteritems():
+            passed = self._passed.get(app_id)
+            if passed is None:
+                filtered[app_id] = names
+                continue
+            app_stats = filtered[app_id] = {}
+            other = {}
+            for name, counts in names.iteritems():
+                if name in passed:
+                    app_stats[name] = counts
+                else:
+                    merge_stats(other, {app_id: {self.other_name: counts}})
+            if other:
+                app_stats[self.other_name] = other[app_id][self.other_name]
+        return filtered
+
+    def _queue_update(self, pl, stats):
+        """
+        Queue commands adding names of (not filtered) `stats` into
+        estimates and summaries. Return state for `_read_update`.
+        """
+        day = self._get_day()
+        queued = []
+        for app_id, names in stats.iteritems():
+            names = [name for name in names if name != self.other_name]
+            if not names:
+                continue
+            hll_key = self._make_key(self.hll_key_format, app_id, day)
+            pl.pfadd(hll_key, *names)
+            pl.expire(hll_key, self.TTL)
+            pl.pfcount(hll_key)
+            guarded = app_id in self._passed
+            if guarded:
+                args = [self.max_names, self.TTL]
+                for name in names:
+                    args.extend((name, stats[app_id][name].get('NUMBER') or 1))
+                keys = [self._make_key(self.counts_key_format, app_id, day),
+                        self._make_key(self.errors_key_format, app_id, day)]
+                # Registered scripts make pipeline check them with
+                # an extra round trip, redis caches evaluated script anyway
+                pl.eval(self.update_script, len(keys), *(keys + args))
+            queued.append((app_id, names, guarded))
+        return day, queued
+
+    def _read_update(self, state, results):
+        """
+        Update names let through with `results` of commands
+        queued by `_queue_update`.
+        """
+        day, queued = state
+        if day != self._day:
+            return
+        results = iter(results)
+        for app_id, names, guarded in queued:
+            # Results of pfadd and expire
+            next(results)
+            next(results)
+            estimate = next(results)
+            if guarded:
+                passed = self._passed[app_id]
+                for name, name_passed in izip(names, next(results)):
+                    if name_passed:
+                        passed.add(name)
+                    else:
+                        passed.discard(name)
+            elif estimate >= self.max_names * self.GUARD_SHARE:
+                self._passed[app_id] = set()
@@ -0,0 +1,136 @@
+# encoding: utf-8
+import os
+import atexit
+import logging
+import threading
+from time import time
+from Queue import Queue, Empty, Full
+
+from .util import merge_stats
+
+
+log = logging.getLogger(__name__)
+
+
+class StatsCoalescer(object):
+    """
+    Merges incoming stats into in-memory aggregates and writes them
+    with a single `flush_func(apps_stats, tasks_stats)` call
+    from a background thread.
+
+    Parameters:
+      - 'flush_func' -- function to write aggregated stats with
+      - 'interval' -- flush period in milliseconds
+      - 'max_entries' -- number of aggregated (app_id, name) pairs
+      to flush immediately after
+      - 'queue_size' -- number of aggregates waiting to be flushed. When
+      queue is full, aggregate is flushed synchronously by the caller.
+    """
+
+    def __init__(self, flush_func, interval=1000, max_entries=10000,
+                 queue_size=16):
+        self.flush_func = flush_func
+        self.interval = interval / 1000.0
+        self.max_entries = max_entries
+        self._queue = Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._apps_stats = {}
+        self._tasks_stats = {}
+        self._entries = 0
+        self._last_swap = time()
+        self._thread = None
+        self._pid = None
+        self._closed = threading.Event()
+        atexit.register(self.close)
+
+    def _ensure_thread(self):
+        # Thread is started lazily, so it is alive in forked workers
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='stats-coalescer')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _swap(self):
+        """
+        Return accumulated aggregates replacing them by empty ones.
+        Must be called with `_lock` held.
+        """
+        batch = self._apps_stats, self._tasks_stats
+        self._apps_stats = {}
+        self._tasks_stats = {}
+        self._entries = 0
+        self._last_swap = time()
+        return batch
+
+    def _flush(self, batch):
+        apps_stats, tasks_stats = batch
+        if not (apps_stats or tasks_stats):
+            return
+        try:
+            self.flush_func(apps_stats, tasks_stats)
+        except Exception:
+            log.exception("Failed to flush coalesced stats")
+
+    def _enqueue(self, batch):
+        try:
+            self._queue.put_nowait(batch)
+        except Full:
+            log.warning("Coalesced stats queue is full, flushing in place")
+            self._flush(batch)
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                self._flush(self._queue.get(timeout=self.interval))
+            except Empty:
+                pass
+            batch = None
+            with self._lock:
+                if time() - self._last_swap >= self.interval:
+                    batch = self._swap()
+            if batch is not None:
+                self._flush(batch)
+
+    def add(self, apps_stats, tasks_stats):
+        """
+        Merge stats into aggregates, which are flushed
+        every `interval` or when `max_entries` is reached.
+        """
+        if self._closed.is_set():
+            self.flush_func(apps_stats, tasks_stats)
+            return
+        self._ensure_thread()
+        batch = None
+        with self._lock:
+            if apps_stats:
+                self._entries += merge_stats(self._apps_stats, apps_stats)
+            if tasks_stats:
+                self._entries += merge_stats(self._tasks_stats, tasks_stats)
+            if self._entries >= self.max_entries:
+                batch = self._swap()
+        if batch is not None:
+            self._enqueue(batch)
+
+    def close(self):
+        """
+        Stop background thread and flush everything accumulated.
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.interval * 2)
+        while True:
+            try:
+                self._flush(self._queue.get_nowait())
+            except Empty:
+                break
+        with self._lock:
+            batch = self._swap()
+        self._flush(batch)
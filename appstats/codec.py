@@ -0,0 +1,85 @@
+# encoding: utf-8
+import json
+import zlib
+
+import msgpack
+
+
+JSON_CONTENT_TYPE = 'application/json'
+COMPACT_CONTENT_TYPE = 'application/x-appstats-msgpack'
+
+# Limit of decompressed data size, so small gzip bombs can't eat memory
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+
+def encode_compact(stats):
+    """
+    Return `stats` dict encoded in the compact format: msgpack of
+    `[fields, stats]`, where `fields` is the list of field keys and counts
+    of each name are flat lists of field indexes and values, e.g.
+    `[['NUMBER', 'real_time'], {'app': {'name': [0, 3, 1, 1.5]}}]`.
+    """
+    fields = []
+    indexes = {}
+    compact_stats = {}
+    for app_id, names in stats.iteritems():
+        compact_names = compact_stats[app_id] = {}
+        for name, counts in names.iteritems():
+            values = compact_names[name] = []
+            for field, val in counts.iteritems():
+                index = indexes.get(field)
+                if index is None:
+                    index = indexes[field] = len(fields)
+                    fields.append(field)
+                values.extend((index, val))
+    return msgpack.packb([fields, compact_stats])
+
+
+def decode_compact(data):
+    """
+    Return stats dict decoded from the compact format.
+    Raise ValueError if data is malformed.
+    """
+    try:
+        fields, compact_stats = msgpack.unpackb(data, encoding='utf-8')
+        stats = {}
+        for app_id, names in compact_stats.iteritems():
+            app_stats = stats[app_id] = {}
+            for name, values in names.iteritems():
+                app_stats[name] = {fields[values[i]]: values[i + 1]
+                                   for i in xrange(0, len(values), 2)}
+        return stats
+    except (msgpack.UnpackException, TypeError, ValueError,
+            AttributeError, IndexError) as e:
+        raise ValueError("Malformed compact stats: {}".format(e))
+
+
+def decompress(data, encoding):
+    """
+    Return `data` decoded from content `encoding` (gzip or identity).
+    Raise ValueError for unsupported, malformed or too large data.
+    """
+    if not encoding or encoding == 'identity':
+        return data
+    if encoding != 'gzip':
+        raise ValueError("Unsupported content encoding: {}".format(encoding))
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(data, MAX_DECOMPRESSED_SIZE)
+    except zlib.error as e:
+        raise ValueError("Malformed gzip data: {}".format(e))
+    if decompressor.unconsumed_tail:
+        raise ValueError("Decompressed data is too large")
+    return data
+
+
+def decode_stats(data, content_type, encoding=None):
+    """
+    Return stats dict posted as `data` with `content_type`
+    and content `encoding`.
+    Raise ValueError if stats can't be decoded.
+    """
+    data = decompress(data, encoding)
+    if content_type == COMPACT_CONTENT_TYPE:
+        return decode_compact(data)
+    return json.loads(data)
@@ -2,8 +2,68 @@ REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0
 
+# Rotate rolling counters with a server-side lua script (redis >= 2.6)
+ROLLING_COUNTER_LUA = False
+# Keep rolling counters in ring buffers rotated lazily on read (redis >= 2.6)
+ROLLING_COUNTER_RING = False
+
+# Accumulate periodic counters data in separate keys for each interval
+PERIODIC_COUNTER_EPOCHS = False
+# Store periodic counters docs bucketed by hour or day
+PERIODIC_BUCKETED_DOCS = False
+# Fields to store histograms of in periodic counters, e.g. ['real_time'].
+# Histograms are sent by clients in '<field>:hist' fields
+HISTOGRAM_FIELDS = []
+# Feed only the most accurate periodic counter with stats and derive
+# the others from it during `manage.py update_counters`
+CASCADE_ROLLUPS = False
+
+# Use short integer ids of app_ids, names and fields in redis keys.
+# Existing data can be moved with `manage.py migrate_keys`.
+# Ids unused for two weeks are removed by `manage.py update_counters`
+COMPACT_KEYS = False
+
+# Keep counters of at most CARDINALITY_MAX_NAMES most frequent names
+# of each app_id a day, counting the rest as CARDINALITY_OTHER_NAME
+CARDINALITY_GUARD = False
+CARDINALITY_MAX_NAMES = 1000
+CARDINALITY_OTHER_NAME = '__other__'
+
+# Merge posted stats in memory and write them to redis every
+# COALESCE_INTERVAL milliseconds or after COALESCE_MAX_ENTRIES names
+COALESCE_STATS = False
+COALESCE_INTERVAL = 1000
+COALESCE_MAX_ENTRIES = 10000
+COALESCE_QUEUE_SIZE = 16
+
+# Number of chart series cached in each process until the next rollup.
+# With CHART_CACHE_REDIS cached series are shared through redis
+# for CHART_CACHE_TTL seconds
+CHART_CACHE_SIZE = 256
+CHART_CACHE_REDIS = False
+CHART_CACHE_TTL = 3600
+# Number of points each chart series is downsampled to (None to disable)
+CHART_MAX_POINTS = 500
+
+# Keep top names for each sort option in redis, fed with posted stats
+# and rebuilt during `manage.py update_cache`, and read stats tables
+# from them and rolling counters
+LEADERBOARDS = False
+# Search names with trigram index in redis, rebuilt during
+# `manage.py update_cache`. With COMPACT_KEYS it keeps ids of names
+NAMES_INDEX = False
+
+# Check each hourly interval of apps stats for anomalies as soon as
+# it is stored, comparing it with running stats of hour of week
+ANOMALY_SCORING = False
+ANOMALY_SCORING_FIELDS = ['NUMBER', 'real_time']
+# Number of standard deviations, value exceeds mean by
+ANOMALY_SCORING_THRESHOLD = 4.0
+
 MONGO_URI = 'mongodb://127.0.0.1:27017'
 MONGO_DB_NAME = 'appstats'
+# Events are removed by ttl index, see `manage.py migrate_indexes`
+EVENTS_TTL_DAYS = 182
 
 APP_EMAIL = 'appstats@mail.com'
 INFO_EMAILS = []
@@ -5,10 +5,13 @@ from time import sleep
 from calendar import timegm
 from datetime import datetime, timedelta, time
 from functools import wraps
+from itertools import izip
 
+from pymongo import UpdateOne
 from pymongo.errors import AutoReconnect
 
-from .util import lock
+from .util import lock, chunks, check_hist, merge_hist, is_number
+from .util import HIST_SUFFIX
 from .anomaly import Anomaly
 
 log = logging.getLogger(__name__)
@@ -27,6 +30,262 @@ def with_rolling_counter_lock(func):
     return wrapper
 
 
+def check_stats(stats):
+    """
+    Raise ValueError if `stats` aren't nested dicts of app_ids, names
+    and counts, any app_id or name can't be used as a part of redis key,
+    any count isn't a finite number or any histogram is malformed.
+    """
+    if not isinstance(stats, dict):
+        raise ValueError("Stats have to be a dict of app_ids")
+    for app_id, names in stats.iteritems():
+        if not isinstance(app_id, basestring):
+            raise ValueError("App_id has to be a string")
+        if ',' in app_id:
+            raise ValueError("App_id can't contain ',' (comma)")
+        if not isinstance(names, dict):
+            raise ValueError("Stats of app_id have to be a dict of names")
+        for name, counts in names.iteritems():
+            if not isinstance(name, basestring):
+                raise ValueError("Name has to be a string")
+            if ',' in name:
+                raise ValueError("Name can't contain ',' (comma)")
+            if not isinstance(counts, dict):
+                raise ValueError("Counts have to be a dict of fields")
+            for field, val in counts.iteritems():
+                if not isinstance(field, basestring):
+                    raise ValueError("Field has to be a string")
+                if field.endswith(HIST_SUFFIX):
+                    check_hist(val)
+                elif not is_number(val):
+                    raise ValueError("Invalid value of field {!r}: {!r}"
+                                     .format(field, val))
+
+
+def registry_scores(stats, now):
+    """
+    Return `(apps_scores, names_scores)` tuple with `now` timestamp for
+    each app_id and name of `stats`, ready to be added into app_ids and
+    names registries of counters. Scores are lists of score and member
+    pairs passed to `zadd` as positional args, so members can't clash
+    with its keyword args (e.g. a name called 'name').
+    """
+    apps_scores = []
+    names_scores = {}
+    for app_id, names in stats.iteritems():
+        apps_scores.extend((now, app_id))
+        app_scores = names_scores[app_id] = []
+        for name in names:
+            app_scores.extend((now, name))
+    return apps_scores, names_scores
+
+
+def iter_interned(interner, kind, values, chunk_size):
+    """
+    Yield `values` of given `kind`, making sure each chunk of them has
+    ids with a single `interner` call before it's yielded.
+    """
+    if interner is None:
+        for value in values:
+            yield value
+        return
+    for chunk in chunks(values, chunk_size):
+        interner.intern(kind, chunk)
+        for value in chunk:
+            yield value
+
+
+class KeyInterner(object):
+    """
+    Maps app_ids, names and fields to short integer ids, so counters
+    can use them in redis keys instead of the original strings.
+    Ids are kept in redis hashes (one per kind) and looked up on demand.
+    Each process caches ids it used in two generations, which are
+    rotated every `CACHE_GENERATION` seconds, so ids unused for two
+    generations leave the cache.
+
+    Every id taken into cache (looked up or moved into the current
+    generation) marks its value as used in a sorted set of the kind.
+    `prune` removes ids of values unused for `KEEP_DAYS`, which is
+    longer than counters keep names in their registries and much longer
+    than any process caches them, so the hashes don't grow with churn.
+    Removed ids aren't reused: a value seen again gets a new one.
+    Values of ids are kept in another hash of the kind for `get_values`.
+
+    Parameters:
+      - 'db' -- redis db instance to keep ids in
+      - 'redis_prefix' -- prefix used in each redis key
+    """
+
+    KINDS = ('app_id', 'name', 'field')
+
+    ids_key_format = '%(prefix)s,interned,%(kind)s'
+    last_id_key_format = '%(prefix)s,interned,%(kind)s,last_id'
+    used_key_format = '%(prefix)s,interned,%(kind)s,used'
+    values_key_format = '%(prefix)s,interned,%(kind)s,values'
+
+    CACHE_GENERATION = 3600
+    KEEP_DAYS = 14
+    PRUNE_CHUNK_SIZE = 1000
+
+    # Return ids of ARGV[3..ARGV[2]+2] values from hash KEYS[1], creating
+    # missing ones with counter KEYS[2] and keeping values of ids in hash
+    # KEYS[4], and mark them and the rest of ARGV values as used at
+    # ARGV[1] in sorted set KEYS[3]
+    intern_script = """
+        local now = ARGV[1]
+        local num_values = tonumber(ARGV[2])
+        local ids = {}
+        for i = 3, num_values + 2 do
+            local id = redis.call('HGET', KEYS[1], ARGV[i])
+            if not id then
+                id = redis.call('INCR', KEYS[2])
+                redis.call('HSET', KEYS[1], ARGV[i], id)
+            end
+            redis.call('HSET', KEYS[4], id, ARGV[i])
+            ids[#ids + 1] = id
+        end
+        for i = 3, #ARGV do
+            redis.call('ZADD', KEYS[3], now, ARGV[i])
+        end
+        return ids
+    """
+
+    # Remove at most ARGV[2] values used before ARGV[1] from sorted set
+    # KEYS[2], their ids from hash KEYS[1] and values of the ids from
+    # hash KEYS[3], return number of them
+    prune_script = """
+        local values = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf',
+                                  '(' .. ARGV[1], 'LIMIT', 0, ARGV[2])
+        if #values > 0 then
+            local ids = redis.call('HMGET', KEYS[1], unpack(values))
+            for i = 1, #ids do
+                if ids[i] then
+                    redis.call('HDEL', KEYS[3], ids[i])
+                end
+            end
+            redis.call('HDEL', KEYS[1], unpack(values))
+            redis.call('ZREM', KEYS[2], unpack(values))
+        end
+        return #values
+    """
+
+    def __init__(self, db, redis_prefix):
+        self.db = db
+        self.prefix = redis_prefix
+        self._ids = {kind: {} for kind in self.KINDS}
+        self._old_ids = {kind: {} for kind in self.KINDS}
+        self._rotated = timegm(datetime.utcnow().utctimetuple())
+        self._intern_script = db.register_script(self.intern_script)
+        self._prune_script = db.register_script(self.prune_script)
+
+    def _make_key(self, key_format, kind):
+        return key_format % dict(prefix=self.prefix, kind=kind)
+
+    def _rotate(self):
+        """
+        Start new cache generation, if the current one is old enough.
+        """
+        now = timegm(datetime.utcnow().utctimetuple())
+        if now - self._rotated >= self.CACHE_GENERATION:
+            self._old_ids = self._ids
+            self._ids = {kind: {} for kind in self.KINDS}
+            self._rotated = now
+
+    def intern(self, kind, values):
+        """
+        Make sure all `values` of given `kind` have ids in the current
+        cache generation, using a single script call for missing ones.
+        """
+        self._rotate()
+        ids = self._ids[kind]
+        old_ids = self._old_ids[kind]
+        missing = []
+        moved = []
+        for value in set(values):
+            if value in ids:
+                continue
+            if value in old_ids:
+                ids[value] = old_ids[value]
+                moved.append(value)
+            else:
+                missing.append(value)
+        if not missing and not moved:
+            return
+        keys = [self._make_key(self.ids_key_format, kind),
+                self._make_key(self.last_id_key_format, kind),
+                self._make_key(self.used_key_format, kind),
+                self._make_key(self.values_key_format, kind)]
+        now = timegm(datetime.utcnow().utctimetuple())
+        args = [now, len(missing)] + missing + moved
+        new_ids = self._intern_script(keys=keys, args=args)
+        for value, new_id in izip(missing, new_ids):
+            ids[value] = str(new_id)
+
+    def intern_stats(self, stats):
+        """
+        Make sure all app_ids, names and fields of `stats` have ids.
+        """
+        names = set()
+        fields = set()
+        for app_id in stats:
+            for name, counts in stats[app_id].iteritems():
+                names.add(name)
+                fields.update(counts)
+        self.intern('app_id', stats)
+        self.intern('name', names)
+        self.intern('field', fields)
+
+    def get_id(self, kind, value):
+        id_ = self._ids[kind].get(value)
+        if id_ is None:
+            self.intern(kind, [value])
+            id_ = self._ids[kind][value]
+        return id_
+
+    def get_values(self, kind, ids):
+        """
+        Return list of values of `ids` of given `kind`,
+        with None for ids which were removed.
+        """
+        if not ids:
+            return []
+        values_key = self._make_key(self.values_key_format, kind)
+        return self.db.hmget(values_key, ids)
+
+    def intern_kwargs(self, kwargs):
+        """
+        Return copy of key format `kwargs`
+        with app_id, name and field replaced by ids.
+        """
+        self._rotate()
+        kwargs = dict(kwargs)
+        for kind in self.KINDS:
+            if kind in kwargs:
+                kwargs[kind] = self.get_id(kind, kwargs[kind])
+        return kwargs
+
+    def prune(self):
+        """
+        Remove ids of values unused for `KEEP_DAYS`.
+        Return number of removed ids.
+        """
+        oldest = datetime.utcnow() - timedelta(days=self.KEEP_DAYS)
+        oldest_ts = timegm(oldest.utctimetuple())
+        removed = 0
+        for kind in self.KINDS:
+            keys = [self._make_key(self.ids_key_format, kind),
+                    self._make_key(self.used_key_format, kind),
+                    self._make_key(self.values_key_format, kind)]
+            while True:
+                num = self._prune_script(
+                    keys=keys, args=[oldest_ts, self.PRUNE_CHUNK_SIZE])
+                removed += num
+                if num < self.PRUNE_CHUNK_SIZE:
+                    break
+        return removed
+
+
 class RollingCounter(object):
     """
     The rolling counter, which stores data only
@@ -41,8 +300,16 @@ class RollingCounter(object):
       - 'interval' -- interval during which the counter stores the data
       - 'secs_per_part' -- accuracy indicator, determine the time range of
       one part in seconds
+      - 'use_lua' -- rotate parts server-side with a registered lua script
+      instead of issuing separate commands for every key (requires
+      redis >= 2.6)
+      - 'interner' -- `KeyInterner` instance to make compact keys with
     """
     REDIS_BUCKET_SIZE = 10000
+    # Number of names read by one pipeline
+    READ_CHUNK_SIZE = 1000
+    # Number of (app_id, name, field) triples rotated by one script call
+    LUA_BATCH_SIZE = 1000
 
     last_val_key_format = '%(prefix)s,%(app_id)s,%(name)s,%(interval)s,%(secs_per_part)s,last_val,%(field)s'
     updated_key_format = '%(prefix)s,%(app_id)s,%(name)s,%(interval)s,%(secs_per_part)s,updated,%(field)s'
@@ -51,23 +318,74 @@ class RollingCounter(object):
     key_format = '%(prefix)s,%(app_id)s,%(name)s,%(interval)s,%(secs_per_part)s,%(field)s'
     lock_key_format = '%(prefix)s,%(interval)s,%(secs_per_part)s,lock'
 
+    # Formats of keys kept for each (app_id, name, field)
+    field_key_formats = (key_format, last_val_key_format, updated_key_format)
+
     MAX_UPDATE_TIME = 5 * 60  # 5 minutes
 
+    # Same algorithm as in `update`, applied to each
+    # (key, last_val_key, updated_key) triple given in KEYS.
+    # ARGV: now timestamp, secs_per_part, number of parts.
+    update_script = """
+        local now_ts = tonumber(ARGV[1])
+        local secs_per_part = tonumber(ARGV[2])
+        local num_of_parts = tonumber(ARGV[3])
+        for i = 1, #KEYS, 3 do
+            local key = KEYS[i]
+            local last_val_key = KEYS[i + 1]
+            local updated_key = KEYS[i + 2]
+
+            if redis.call('LLEN', key) == 0 then
+                for _ = 1, num_of_parts - 1 do
+                    redis.call('RPUSH', key, 0)
+                end
+                redis.call('SET', updated_key, now_ts)
+            end
+
+            local updated = tonumber(redis.call('GET', updated_key)) or now_ts
+            local last_val = tonumber(redis.call('GET', last_val_key)) or 0
+            local passed_time = now_ts - updated
+
+            if passed_time > secs_per_part then
+                local num_of_new_parts = math.floor(passed_time / secs_per_part)
+                local val_per_part = last_val / num_of_new_parts
+                local num_of_shifts = math.min(num_of_parts, num_of_new_parts)
+                for _ = 1, num_of_shifts do
+                    redis.call('LPOP', key)
+                    redis.call('RPUSH', key, val_per_part)
+                end
+                redis.call('SET', last_val_key, 0)
+                local rest_time = passed_time - num_of_new_parts * secs_per_part
+                redis.call('SET', updated_key, now_ts - rest_time)
+            end
+        end
+    """
+
     def __init__(self, db, fields, redis_prefix, stats='apps',
-                 interval=3600, secs_per_part=60):
+                 interval=3600, secs_per_part=60, use_lua=False,
+                 interner=None):
         self.db = db
         self.prefix = '%s_%s' % (redis_prefix, stats)
         self.interval = interval
         self.secs_per_part = secs_per_part
         self._num_of_parts = interval // secs_per_part
         self.fields = fields
+        self.use_lua = use_lua
+        self.interner = interner
+        self._update_script = db.register_script(self.update_script)
 
     def _make_key(self, key_format, **kwargs):
         """
         Return redis key produced by inserting kwargs into given `key_format`.
         Specify format with `prefix`, `interval` and `secs_per_part` values
         taken from counter object.
+        If counter has interner, app_id, name and field are replaced by ids.
         """
+        if self.interner is not None:
+            kwargs = self.interner.intern_kwargs(kwargs)
+        return self._make_plain_key(key_format, **kwargs)
+
+    def _make_plain_key(self, key_format, **kwargs):
         kwargs.update(prefix=self.prefix, interval=self.interval,
                       secs_per_part=self.secs_per_part)
         return key_format % kwargs
@@ -75,18 +393,24 @@ class RollingCounter(object):
     def _get_app_ids(self):
         """
         Return all app_ids this counter works with.
+        With interner, ids of them and of fields are looked up at once.
         """
         key_app_ids = self._make_key(self.app_ids_key_format)
-        for app_id, _ in self.db.zscan_iter(key_app_ids):
-            yield app_id
+        app_ids = [app_id for app_id, _ in self.db.zscan_iter(key_app_ids)]
+        if self.interner is not None:
+            self.interner.intern('app_id', app_ids)
+            self.interner.intern('field', self.fields)
+        return app_ids
 
     def _get_names(self, app_id):
         """
         Return all names this counter watching over.
+        With interner, ids of each chunk of names are looked up at once.
         """
         key_names = self._make_key(self.names_key_format, app_id=app_id)
-        for name, _ in self.db.zscan_iter(key_names):
-            yield name
+        names = (name for name, _ in self.db.zscan_iter(key_names))
+        return iter_interned(self.interner, 'name', names,
+                             self.READ_CHUNK_SIZE)
 
     def _remove_old_app_ids(self, latest):
         latest_ts = timegm(latest.utctimetuple())
@@ -114,6 +438,10 @@ class RollingCounter(object):
         latest = now_dt - timedelta(days=10)
 
         self._remove_old_app_ids(latest)
+        if self.use_lua:
+            self._update_with_script(now_ts, latest)
+            return
+
         pl = self.db.pipeline()
         for app_id in self._get_app_ids():
             self._remove_old_names(app_id, latest)
@@ -161,6 +489,33 @@ class RollingCounter(object):
                         pl.set(updated_key, now_ts - rest_time)
                     if len(pl) > self.REDIS_BUCKET_SIZE:
                         pl.execute()
+        pl.execute()
+
+    def _update_with_script(self, now_ts, latest):
+        """
+        Perform the same rotation as `update` does, but server-side:
+        keys of up to `LUA_BATCH_SIZE` (app_id, name, field) triples
+        are rotated by a single `update_script` call.
+        """
+        args = [now_ts, self.secs_per_part, self._num_of_parts]
+        keys = []
+        for app_id in self._get_app_ids():
+            self._remove_old_names(app_id, latest)
+            for name in self._get_names(app_id):
+                for field in self.fields:
+                    keys.append(self._make_key(self.key_format, name=name,
+                                               app_id=app_id, field=field))
+                    keys.append(self._make_key(self.last_val_key_format,
+                                               app_id=app_id, name=name,
+                                               field=field))
+                    keys.append(self._make_key(self.updated_key_format,
+                                               app_id=app_id, name=name,
+                                               field=field))
+                    if len(keys) >= 3 * self.LUA_BATCH_SIZE:
+                        self._update_script(keys=keys, args=args)
+                        keys = []
+        if keys:
+            self._update_script(keys=keys, args=args)
 
     def get_vals(self):
         """
@@ -168,33 +523,76 @@ class RollingCounter(object):
         Result format example:
             {'app_id1': {'name1': {'field1': 1, 'field2': 2}}}
         """
-        pl = self.db.pipeline()
-        app_id_names = {app_id: list(self._get_names(app_id))
-                        for app_id in list(self._get_app_ids())}
-        for app_id, names in app_id_names.iteritems():
-            for name in names:
-                for field in self.fields:
-                    key = self._make_key(self.key_format, name=name,
-                                         app_id=app_id, field=field)
-                    last_val_key = self._make_key(self.last_val_key_format,
-                                                  app_id=app_id, name=name,
-                                                  field=field)
-                    pl.get(last_val_key)
-                    pl.lrange(key, 0, -1)
-        pl_res = pl.execute()
         res = {}
-        for app_id, names in app_id_names.iteritems():
-            res[app_id] = {}
-            for name in names:
-                counts = {}
-                for field in self.fields:
-                    last_val = float(pl_res.pop(0) or '0.0')
-                    count = sum(map(float, pl_res.pop(0)))
-                    count += last_val
-                    counts[field] = count
-                res[app_id][name] = counts
+        for app_id, name, counts in self.iter_vals():
+            res.setdefault(app_id, {})[name] = counts
         return res
 
+    def iter_vals(self, chunk_size=None):
+        """
+        Yield `(app_id, name, counts)` tuples for all data counter has.
+        Counts format example:
+            {'field1': 1, 'field2': 2}
+        """
+        for app_id, names, counts in self.iter_chunks(chunk_size):
+            for name, name_counts in izip(names, counts):
+                yield app_id, name, name_counts
+
+    def iter_chunks(self, chunk_size=None):
+        """
+        Yield `(app_id, names, counts)` tuples, where `counts` is a list
+        of counts for each name. Each tuple is read by a separate pipeline
+        and contains not more than `chunk_size` names
+        (`READ_CHUNK_SIZE` by default).
+        """
+        chunk_size = chunk_size or self.READ_CHUNK_SIZE
+        for app_id in self._get_app_ids():
+            for names in chunks(self._get_names(app_id), chunk_size):
+                yield app_id, names, self.get_counts(app_id, names)
+
+    def get_counts(self, app_id, names):
+        """
+        Return list of counts for each of `names` of given `app_id`
+        using a single pipeline.
+        """
+        if self.interner is not None:
+            self.interner.intern('name', names)
+        pl = self.db.pipeline()
+        now_ts = timegm(datetime.utcnow().utctimetuple())
+        for name in names:
+            for field in self.fields:
+                self._queue_read(pl, app_id, name, field)
+        pl_res = iter(pl.execute())
+        res = []
+        for name in names:
+            counts = {}
+            for field in self.fields:
+                counts[field] = self._read_count(pl_res, now_ts)
+            res.append(counts)
+        return res
+
+    def _queue_read(self, pl, app_id, name, field):
+        """
+        Queue commands needed to read a count specified by
+        `app_id`, `name` and `field` into pipeline `pl`.
+        """
+        key = self._make_key(self.key_format, name=name,
+                             app_id=app_id, field=field)
+        last_val_key = self._make_key(self.last_val_key_format,
+                                      app_id=app_id, name=name,
+                                      field=field)
+        pl.get(last_val_key)
+        pl.lrange(key, 0, -1)
+
+    def _read_count(self, pl_res, now_ts):
+        """
+        Consume results of commands queued by `_queue_read`
+        from `pl_res` iterator and return the count.
+        """
+        last_val = float(next(pl_res) or '0.0')
+        count = sum(map(float, next(pl_res)))
+        return count + last_val
+
     def incrby(self, app_id, name, field, increment):
         """
         Add `increment` to value of a count
@@ -219,19 +617,23 @@ class RollingCounter(object):
         pl.execute()
 
     def incrby_bulk(self, stats):
-        pl = self.db.pipeline()
-        key_app_ids = self._make_key(self.app_ids_key_format)
+        check_stats(stats)
+        if self.interner is not None:
+            self.interner.intern_stats(stats)
         now = timegm(datetime.utcnow().utctimetuple())
-        time_updates_apps = {}
+        pl = self.db.pipeline()
+        self._queue_incrby_bulk(pl, stats, now,
+                                registry_scores(stats, now))
+        pl.execute()
+
+    def _queue_incrby_bulk(self, pl, stats, now, scores):
+        """
+        Queue commands adding checked `stats` at `now` timestamp into
+        pipeline `pl`. `scores` are made by `registry_scores` function.
+        """
+        apps_scores, names_scores = scores
         for app_id in stats:
-            if ',' in app_id:
-                raise ValueError("App_id can't contain ',' (comma)")
-            time_updates_apps[app_id] = now
-            time_updates_names = {}
             for name, counts in stats[app_id].iteritems():
-                if ',' in name:
-                    raise ValueError("Name can't contain ',' (comma)")
-                time_updates_names[name] = now
                 for field, val in counts.iteritems():
                     if field not in self.fields:
                         continue
@@ -239,11 +641,144 @@ class RollingCounter(object):
                                                   app_id=app_id, name=name,
                                                   field=field)
                     pl.incrbyfloat(last_val_key, val)
-            key_names = self._make_key(self.names_key_format, app_id=app_id)
-            pl.zadd(key_names, **time_updates_names)
-        pl.zadd(key_app_ids, **time_updates_apps)
+            if names_scores[app_id]:
+                key_names = self._make_key(self.names_key_format,
+                                           app_id=app_id)
+                pl.zadd(key_names, *names_scores[app_id])
+        if apps_scores:
+            key_app_ids = self._make_key(self.app_ids_key_format)
+            pl.zadd(key_app_ids, *apps_scores)
+
+
+class RingRollingCounter(RollingCounter):
+    """
+    The rolling counter, which keeps each count in a fixed size ring of
+    parts indexed by `timestamp // secs_per_part % number of parts`.
+    Every part remembers the epoch (`timestamp // secs_per_part`) it was
+    written in, so outdated parts are reset on write and skipped on read.
+    Data is always actual and `update` doesn't need to shift anything,
+    it only removes outdated app_ids and names.
+
+    Ring holds one part more than the interval needs, the oldest part is
+    taken into account proportionally to the time it overlaps the interval.
+
+    Parameters are the same as for `RollingCounter`.
+    """
+
+    ring_key_format = '%(prefix)s,%(app_id)s,%(name)s,%(interval)s,%(secs_per_part)s,ring,%(field)s'
+
+    field_key_formats = (ring_key_format,)
+
+    # Add ARGV[i + 3] to the current part of the ring stored in KEYS[i].
+    # ARGV: epoch, part index, key ttl, increments...
+    incrby_script = """
+        local epoch = ARGV[1]
+        local val_field = 'v' .. ARGV[2]
+        local epoch_field = 'e' .. ARGV[2]
+        local ttl = tonumber(ARGV[3])
+        for i = 1, #KEYS do
+            local key = KEYS[i]
+            if redis.call('HGET', key, epoch_field) == epoch then
+                redis.call('HINCRBYFLOAT', key, val_field, ARGV[i + 3])
+            else
+                redis.call('HMSET', key, epoch_field, epoch,
+                           val_field, ARGV[i + 3])
+            end
+            redis.call('EXPIRE', key, ttl)
+        end
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RingRollingCounter, self).__init__(*args, **kwargs)
+        self._ring_size = self._num_of_parts + 1
+        self._key_ttl = self.interval + 2 * self.secs_per_part
+
+    def _incrby_args(self, now_ts):
+        epoch = now_ts // self.secs_per_part
+        return [epoch, epoch % self._ring_size, self._key_ttl]
+
+    @with_rolling_counter_lock
+    def update(self):
+        """
+        Remove app_ids and names which weren't updated for a long time.
+        """
+        latest = datetime.utcnow() - timedelta(days=10)
+        self._remove_old_app_ids(latest)
+        for app_id in self._get_app_ids():
+            self._remove_old_names(app_id, latest)
+
+    def _queue_read(self, pl, app_id, name, field):
+        key = self._make_key(self.ring_key_format, app_id=app_id,
+                             name=name, field=field)
+        pl.hgetall(key)
+
+    def _read_count(self, pl_res, now_ts):
+        parts = next(pl_res)
+        interval_start = now_ts - self.interval
+        count = 0.0
+        for i in xrange(self._ring_size):
+            epoch = parts.get('e%u' % i)
+            if epoch is None:
+                continue
+            part_end = (int(epoch) + 1) * self.secs_per_part
+            if part_end <= interval_start:
+                continue
+            val = float(parts.get('v%u' % i) or '0.0')
+            part_start = part_end - self.secs_per_part
+            if part_start < interval_start:
+                # Oldest part, only partially belongs to the interval
+                val *= float(part_end - interval_start) / self.secs_per_part
+            count += val
+        return count
+
+    def incrby(self, app_id, name, field, increment):
+        if ',' in name:
+            raise ValueError("Name can't contain ',' (comma)")
+        if ',' in app_id:
+            raise ValueError("App_id can't contain ',' (comma)")
+        if field not in self.fields:
+            return
+
+        pl = self.db.pipeline()
+        key_app_ids = self._make_key(self.app_ids_key_format)
+        key_names = self._make_key(self.names_key_format, app_id=app_id)
+        key = self._make_key(self.ring_key_format, app_id=app_id,
+                             name=name, field=field)
+        now = timegm(datetime.utcnow().utctimetuple())
+        pl.zadd(key_app_ids, now, app_id)
+        pl.zadd(key_names, now, name)
+        self._queue_incrby_script(pl, [key], [increment], now)
         pl.execute()
 
+    def _queue_incrby_script(self, pl, keys, increments, now):
+        # Registered scripts make pipeline check them with
+        # an extra round trip, redis caches evaluated script anyway
+        args = self._incrby_args(now) + increments
+        pl.eval(self.incrby_script, len(keys), *(keys + args))
+
+    def _queue_incrby_bulk(self, pl, stats, now, scores):
+        apps_scores, names_scores = scores
+        keys = []
+        increments = []
+        for app_id in stats:
+            for name, counts in stats[app_id].iteritems():
+                for field, val in counts.iteritems():
+                    if field not in self.fields:
+                        continue
+                    keys.append(self._make_key(self.ring_key_format,
+                                               app_id=app_id, name=name,
+                                               field=field))
+                    increments.append(val)
+            if names_scores[app_id]:
+                key_names = self._make_key(self.names_key_format,
+                                           app_id=app_id)
+                pl.zadd(key_names, *names_scores[app_id])
+        if apps_scores:
+            key_app_ids = self._make_key(self.app_ids_key_format)
+            pl.zadd(key_app_ids, *apps_scores)
+        if keys:
+            self._queue_incrby_script(pl, keys, increments, now)
+
 
 def with_periodic_counter_lock(func):
     @wraps(func)
@@ -275,39 +810,74 @@ class PeriodicCounter(object):
       - 'period' -- interval in hours during which the counter stores the data.
       All data older than this value will be removed.
       Default value is 30 * 24 = 720 (30 days).
+      - 'interner' -- `KeyInterner` instance to make compact keys with
+      - 'bucketed' -- store docs in separate collection, one doc per
+      (app_id, name, hour) for 1 minute intervals or per (app_id, name, day)
+      otherwise. Bucket doc holds arrays of fields values, an item per
+      interval.
+      - 'histograms' -- list of fields to store histograms of, which
+      come in '<field>:hist' fields of stats
     """
 
     key_format = '%(prefix)s,periodic,%(divider)s,%(app_id)s,%(name)s,%(field)s'
+    hist_key_format = '%(prefix)s,periodic,%(divider)s,%(app_id)s,%(name)s,%(field)s,hist'
     prev_upd_key_format = '%(prefix)s,periodic,%(divider)s,prev_upd'
     app_ids_key_format = '%(prefix)s,periodic,%(divider)s,app_ids_set'
     names_key_format = '%(prefix)s,periodic,%(divider)s,%(app_id)s,names_set'
     lock_key_format = '%(prefix)s,periodic,%(divider)s,lock'
 
+    field_key_formats = (key_format, hist_key_format)
+
     MAX_MONGO_RETRIES = 3
     MAX_PASSED_INTERVALS = 5
     MAX_UPDATE_TIME = 5 * 60  # 5 minutes
+    # Number of names read by one pipeline
+    READ_CHUNK_SIZE = 1000
 
     def __init__(self, divider, redis_db, mongo_db, fields,
-                 redis_prefix, stats='apps', period=720):
+                 redis_prefix, stats='apps', period=720, interner=None,
+                 bucketed=False, histograms=()):
         self.redis_db = redis_db
         self.fields = fields
-        self.collection = mongo_db['appstats_%s_periodic-%u' % (stats, divider)]
+        self.histograms = list(histograms)
+        # Fields of stats and docs holding histograms
+        self.hist_fields = [field + HIST_SUFFIX for field in histograms]
         self.prefix = '%s_%s' % (redis_prefix, stats)
         self.divider = divider
         self.period = period
         self.interval = 60 / divider
+        self.interner = interner
+        self.bucketed = bucketed
+        collection_name = 'appstats_%s_periodic-%u' % (stats, divider)
+        if bucketed:
+            collection_name += '-buckets'
+            self.bucket_minutes = 60 if self.interval == 1 else 24 * 60
+            self._num_of_slots = self.bucket_minutes // self.interval
+        self.collection = mongo_db[collection_name]
+        # Object checking stored docs for anomalies (see AnomalyScorer)
+        self.scorer = None
 
     def _get_app_ids(self):
         key_app_ids = self._make_key(self.app_ids_key_format)
-        for app_id, _ in self.redis_db.zscan_iter(key_app_ids):
-            yield app_id
+        app_ids = [app_id for app_id, _
+                   in self.redis_db.zscan_iter(key_app_ids)]
+        if self.interner is not None:
+            self.interner.intern('app_id', app_ids)
+            self.interner.intern('field', list(self.fields) + self.histograms)
+        return app_ids
 
     def _get_names(self, app_id):
         key_names = self._make_key(self.names_key_format, app_id=app_id)
-        for name, _ in self.redis_db.zscan_iter(key_names):
-            yield name
+        names = (name for name, _ in self.redis_db.zscan_iter(key_names))
+        return iter_interned(self.interner, 'name', names,
+                             self.READ_CHUNK_SIZE)
 
     def _make_key(self, key_format, **kwargs):
+        if self.interner is not None:
+            kwargs = self.interner.intern_kwargs(kwargs)
+        return self._make_plain_key(key_format, **kwargs)
+
+    def _make_plain_key(self, key_format, **kwargs):
         kwargs.update(prefix=self.prefix, divider=self.divider)
         return key_format % kwargs
 
@@ -319,7 +889,10 @@ class PeriodicCounter(object):
         tries = self.MAX_MONGO_RETRIES
         while True:
             try:
-                self.collection.insert(docs)
+                if self.bucketed:
+                    self._write_buckets(docs)
+                else:
+                    self.collection.insert_many(docs, ordered=False)
                 break
             except AutoReconnect:
                 log.warn("AutoReconnect exception while inserting "
@@ -329,6 +902,74 @@ class PeriodicCounter(object):
                     raise
                 tries -= 1
                 sleep(0.1)
+        if self.scorer is not None:
+            try:
+                self.scorer.score(self, docs)
+            except Exception:
+                log.exception("Failed to check docs for anomalies")
+
+    def _get_bucket(self, date):
+        """
+        Return start date of bucket containing `date`
+        and index of `date` interval in the bucket.
+        """
+        minutes = date.hour * 60 + date.minute
+        offset = minutes % self.bucket_minutes
+        start = datetime.combine(date.date(), time()) + timedelta(
+            minutes=minutes - offset)
+        return start, offset // self.interval
+
+    def _remove_old_docs(self, now):
+        oldest_date = now - timedelta(hours=self.period)
+        if self.bucketed:
+            # Bucket is removed only when all its intervals are too old
+            oldest_date -= timedelta(minutes=self.bucket_minutes)
+        self.collection.remove({'date': {'$lte': oldest_date}})
+
+    def _write_buckets(self, docs):
+        """
+        Set values of flat `docs` into bucket docs, creating missing ones.
+        """
+        specs = {}
+        updates = []
+        for doc in docs:
+            start, slot = self._get_bucket(doc['date'])
+            spec = dict(app_id=doc['app_id'], name=doc['name'], date=start)
+            specs[doc['app_id'], doc['name'], start] = spec
+            values = {'%s.%u' % (field, slot): doc.get(field, 0.0)
+                      for field in self.fields}
+            values.update(('%s.%u' % (field, slot), doc[field])
+                          for field in self.hist_fields if field in doc)
+            updates.append(UpdateOne(spec, {'$set': values}))
+        empty = {field: [None] * self._num_of_slots
+                 for field in self.fields + self.hist_fields}
+        inits = [UpdateOne(spec, {'$setOnInsert': empty}, upsert=True)
+                 for spec in specs.itervalues()]
+        self.collection.bulk_write(inits, ordered=False)
+        self.collection.bulk_write(updates, ordered=False)
+
+    def _iter_bucket_docs(self, start, end, query):
+        spec = dict(query or {}, date={'$gte': self._get_bucket(start)[0]})
+        if end is not None:
+            spec['date']['$lte'] = end
+        for bucket in self.collection.find(spec).sort('date'):
+            for slot in xrange(self._num_of_slots):
+                date = bucket['date'] + timedelta(minutes=self.interval * slot)
+                if date <= start or (end is not None and date > end):
+                    continue
+                doc = dict(app_id=bucket['app_id'], name=bucket['name'],
+                           date=date)
+                for field in self.fields:
+                    values = bucket.get(field)
+                    doc[field] = values[slot] if values else None
+                if all(doc[field] is None for field in self.fields):
+                    # Nothing was written for this interval
+                    continue
+                for field in self.hist_fields:
+                    values = bucket.get(field)
+                    if values and values[slot]:
+                        doc[field] = values[slot]
+                yield doc
 
     def incrby(self, app_id, name, field, increment):
         if ',' in name:
@@ -351,29 +992,44 @@ class PeriodicCounter(object):
         pl.execute()
 
     def incrby_bulk(self, stats):
-        pl = self.redis_db.pipeline()
-        key_app_ids = self._make_key(self.app_ids_key_format)
+        check_stats(stats)
+        if self.interner is not None:
+            self.interner.intern_stats(stats)
         now = timegm(datetime.utcnow().utctimetuple())
-        time_updates_apps = {}
+        pl = self.redis_db.pipeline()
+        self._queue_incrby_bulk(pl, stats, now,
+                                registry_scores(stats, now))
+        pl.execute()
+
+    def _queue_incrby_bulk(self, pl, stats, now, scores):
+        """
+        Queue commands adding checked `stats` at `now` timestamp into
+        pipeline `pl`. `scores` are made by `registry_scores` function.
+        """
+        apps_scores, names_scores = scores
         for app_id in stats:
-            if ',' in app_id:
-                raise ValueError("App_id can't contain ',' (comma)")
-            time_updates_apps[app_id] = now
-            time_updates_names = {}
             for name, counts in stats[app_id].iteritems():
-                if ',' in name:
-                    raise ValueError("Name can't contain ',' (comma)")
-                time_updates_names[name] = now
                 for field, val in counts.iteritems():
                     if field not in self.fields:
                         continue
                     key = self._make_key(self.key_format, app_id=app_id,
                                          name=name, field=field)
                     pl.incrbyfloat(key, val)
-            key_names = self._make_key(self.names_key_format, app_id=app_id)
-            pl.zadd(key_names, **time_updates_names)
-        pl.zadd(key_app_ids, **time_updates_apps)
-        pl.execute()
+                for field in self.histograms:
+                    hist = counts.get(field + HIST_SUFFIX)
+                    if not hist:
+                        continue
+                    key = self._make_key(self.hist_key_format, app_id=app_id,
+                                         name=name, field=field)
+                    for bucket, count in hist.iteritems():
+                        pl.hincrby(key, bucket, int(count))
+            if names_scores[app_id]:
+                key_names = self._make_key(self.names_key_format,
+                                           app_id=app_id)
+                pl.zadd(key_names, *names_scores[app_id])
+        if apps_scores:
+            key_app_ids = self._make_key(self.app_ids_key_format)
+            pl.zadd(key_app_ids, *apps_scores)
 
     def _remove_old_app_ids(self, latest):
         latest_ts = timegm(latest.utctimetuple())
@@ -419,6 +1075,7 @@ class PeriodicCounter(object):
 
         pl = self.redis_db.pipeline()
         docs = []
+        hist_reads = []
         latest = now - timedelta(days=10)
 
         self._remove_old_app_ids(latest)
@@ -435,31 +1092,87 @@ class PeriodicCounter(object):
                     pl.incrbyfloat(key, -val)
                     val_per_interval = val / passed_intervals
                     doc[field] = val_per_interval
+                for field in self.histograms:
+                    key = self._make_key(self.hist_key_format, app_id=app_id,
+                                         name=name, field=field)
+                    hist_reads.append((doc, field + HIST_SUFFIX, key))
                 docs.append(doc)
+        # Histograms are read with a pipeline per chunk of names
+        for reads in chunks(hist_reads, self.READ_CHUNK_SIZE):
+            read_pl = self.redis_db.pipeline(transaction=False)
+            for _, _, key in reads:
+                read_pl.hgetall(key)
+            for (doc, field, key), counts in izip(reads, read_pl.execute()):
+                hist = {}
+                for bucket, count in counts.iteritems():
+                    count = int(count)
+                    if count:
+                        hist[bucket] = count
+                        # Reduce count (pipelined), emptied buckets
+                        # are kept for the next intervals
+                        pl.hincrby(key, bucket, -count)
+                if hist:
+                    doc[field] = hist
+        num_names = len(docs)
+        # For each passed interval add separate docs with changed date,
+        # histograms can't be split and are kept in the latest docs only
+        for offset_scale in xrange(1, num_intervals):
+            date = now - timedelta(minutes=self.interval * offset_scale)
+            docs.extend([dict(((k, v) for k, v in doc.iteritems()
+                               if k not in self.hist_fields), date=date)
+                         for doc in docs[:num_names]])
         try:
             self._insert_docs(docs)
             pl.execute()
             prev_upd = timegm(now.utctimetuple())
             self.redis_db.set(prev_upd_key, prev_upd)
 
-            oldest_date = now - timedelta(hours=self.period)
-            self.collection.remove({'date': {'$lte': oldest_date}})
-
-            # For each passed interval
-            # add separate doc with changed date
-            for offset_scale in xrange(1, num_intervals):
-                for doc in docs:
-                    offset = self.interval * offset_scale
-                    date = now - timedelta(minutes=offset)
-                    doc['date'] = date
-                    del doc['_id']
-                self._insert_docs(docs)
+            self._remove_old_docs(now)
         except AutoReconnect as e:
             log.warning("Failed to update counters: {}".format(e))
             pl.reset()
 
+    def get_last_update(self):
+        """
+        Return timestamp of the latest stored docs, which changes
+        every time counter stores new docs.
+        """
+        prev_upd_key = self._make_key(self.prev_upd_key_format)
+        return self.redis_db.get(prev_upd_key)
+
+    def iter_docs(self, start, end=None, query=None):
+        """
+        Return flat docs with date in (`start`, `end`] range
+        matching `query`, sorted by date. If `end` is None, return
+        all docs newer than `start`.
+        """
+        if self.bucketed:
+            return self._iter_bucket_docs(start, end, query)
+        spec = dict(query or {}, date={'$gt': start})
+        if end is not None:
+            spec['date']['$lte'] = end
+        return self.collection.find(spec).sort('date')
+
     def find_anomalies(self, ref_hours, check_hours, sensitivity):
+        def get_bucket_avg_data(start_date, end_date):
+            # Intervals are slots of bucket docs, so they are averaged
+            # from flat docs in process
+            sums = {}
+            for doc in self.iter_docs(start_date, end_date):
+                if doc['date'] >= end_date:
+                    continue
+                for field in self.fields:
+                    if doc[field] is None:
+                        continue
+                    key = doc['app_id'], doc['name'], field
+                    total, num = sums.get(key, (0.0, 0))
+                    sums[key] = total + doc[field], num + 1
+            return {key: total / num
+                    for key, (total, num) in sums.iteritems()}
+
         def get_avg_data(start_date, end_date):
+            if self.bucketed:
+                return get_bucket_avg_data(start_date, end_date)
             groupper = {'_id': {'app_id': '$app_id', 'name': '$name'}}
             for field in self.fields:
                 groupper[field] = {'$avg': '$' + field}
@@ -467,7 +1180,7 @@ class PeriodicCounter(object):
                 {'$match': {'date': {'$gt': start_date, '$lt': end_date}}},
                 {'$group': groupper}
             ]
-            raw_results = self.collection.aggregate(pipeline)['result']
+            raw_results = self.collection.aggregate(pipeline)
             results = {}
             for raw_result in raw_results:
                 app_id = raw_result['_id']['app_id']
@@ -497,3 +1210,363 @@ class PeriodicCounter(object):
                 anomaly = Anomaly(app_id=app_id, name=name, field=field)
                 anomalies.append(anomaly)
         return anomalies
+
+
+class EpochPeriodicCounter(PeriodicCounter):
+    """
+    The PeriodicCounter, which accumulates data of each interval (epoch)
+    in separate redis hashes, one per (app_id, name), with fields as hash
+    keys. Update reads closed epochs with a few pipelines, inserts their
+    docs and drops them, so increments of the current epoch are never
+    read or subtracted concurrently.
+
+    Epoch is closed `CLOSE_DELAY` seconds after its end, so increments
+    sent just before the end (or by hosts with clocks slightly behind)
+    still get into it. Its keys are renamed into snapshot keys before
+    they are read, so nothing written meanwhile is deleted unread.
+    Increments, which come after epoch doc was stored, are dropped with
+    a warning, as they would make a second doc of the same interval.
+
+    Epochs are kept in redis for `CATCHUP_HOURS`, so after updates were
+    missed, docs of each passed interval are made from its own data and
+    inserted epoch by epoch.
+
+    Parameters are the same as for `PeriodicCounter`.
+    """
+
+    epoch_key_format = '%(prefix)s,periodic,%(divider)s,%(epoch)s,%(app_id)s,%(name)s'
+    epoch_names_key_format = '%(prefix)s,periodic,%(divider)s,%(epoch)s,names'
+    epochs_key_format = '%(prefix)s,periodic,%(divider)s,epochs'
+    snapshot_key_format = epoch_key_format + ',snapshot'
+    snapshot_names_key_format = epoch_names_key_format + ',snapshot'
+
+    # Data is kept in epoch keys only
+    field_key_formats = ()
+
+    # Time to keep not updated epochs for
+    CATCHUP_HOURS = 24
+    # Seconds after the end of epoch it's closed in
+    CLOSE_DELAY = 5
+
+    # Remove epoch ARGV[1] from sorted set KEYS[1] unless it was written
+    # again, i.e. its names set KEYS[2] exists
+    forget_epoch_script = """
+        if redis.call('EXISTS', KEYS[2]) == 0 then
+            redis.call('ZREM', KEYS[1], ARGV[1])
+        end
+    """
+
+    def _get_epoch(self, ts):
+        return ts // (self.interval * 60)
+
+    def _get_epoch_date(self, epoch):
+        """
+        Return date of docs made from `epoch`, which is the end of its
+        interval (as for `PeriodicCounter` docs).
+        """
+        return datetime.utcfromtimestamp((epoch + 1) * self.interval * 60)
+
+    def incrby(self, app_id, name, field, increment):
+        self.incrby_bulk({app_id: {name: {field: increment}}})
+
+    def _queue_incrby_bulk(self, pl, stats, now, scores):
+        epoch = self._get_epoch(now)
+        ttl = self.CATCHUP_HOURS * 3600 + self.interval * 60
+        members = []
+        for app_id in stats:
+            for name, counts in stats[app_id].iteritems():
+                key = self._make_key(self.epoch_key_format, epoch=epoch,
+                                     app_id=app_id, name=name)
+                for field, val in counts.iteritems():
+                    if field not in self.fields:
+                        continue
+                    pl.hincrbyfloat(key, field, val)
+                # Histogram buckets are kept as '<field>:hist:<bucket>'
+                for field in self.hist_fields:
+                    for bucket, count in (counts.get(field) or {}).iteritems():
+                        pl.hincrby(key, '%s:%s' % (field, bucket), int(count))
+                pl.expire(key, ttl)
+                members.append('%s,%s' % (app_id, name))
+        if members:
+            epoch_names_key = self._make_key(self.epoch_names_key_format,
+                                             epoch=epoch)
+            epochs_key = self._make_key(self.epochs_key_format)
+            pl.sadd(epoch_names_key, *members)
+            pl.expire(epoch_names_key, ttl)
+            pl.zadd(epochs_key, epoch, epoch)
+
+    def _read_epoch(self, epoch):
+        """
+        Return docs and snapshot keys of all names accumulated in `epoch`.
+        Snapshot of previous update, which failed, is read again.
+        """
+        date = self._get_epoch_date(epoch)
+        epoch_names_key = self._make_key(self.epoch_names_key_format,
+                                         epoch=epoch)
+        names_key = self._make_key(self.snapshot_names_key_format,
+                                   epoch=epoch)
+        pl = self.redis_db.pipeline()
+        pl.renamenx(epoch_names_key, names_key)
+        # Epoch which was renamed already has no names key
+        pl.execute(raise_on_error=False)
+        members = self.redis_db.sscan_iter(names_key,
+                                           count=self.READ_CHUNK_SIZE)
+        docs = []
+        keys = [names_key]
+        for chunk in chunks(members, self.READ_CHUNK_SIZE):
+            names = [member.split(',', 1) for member in chunk]
+            if self.interner is not None:
+                self.interner.intern('app_id', [pair[0] for pair in names])
+                self.interner.intern('name', [pair[1] for pair in names])
+            pl = self.redis_db.pipeline(transaction=False)
+            for app_id, name in names:
+                key = self._make_key(self.snapshot_key_format, epoch=epoch,
+                                     app_id=app_id, name=name)
+                pl.renamenx(self._make_key(self.epoch_key_format,
+                                           epoch=epoch, app_id=app_id,
+                                           name=name), key)
+                pl.hgetall(key)
+                keys.append(key)
+            results = pl.execute(raise_on_error=False)
+            for (app_id, name), counts in izip(names, results[1::2]):
+                doc = dict(name=name, app_id=app_id, date=date)
+                for field in self.fields:
+                    doc[field] = float(counts.get(field) or 0.0)
+                for field in self.hist_fields:
+                    prefix = field + ':'
+                    hist = {k[len(prefix):]: int(count)
+                            for k, count in counts.iteritems()
+                            if k.startswith(prefix)}
+                    if hist:
+                        doc[field] = hist
+                docs.append(doc)
+        return docs, keys
+
+    def _drop_epoch(self, epoch, keys):
+        pl = self.redis_db.pipeline()
+        for keys_chunk in chunks(keys, self.READ_CHUNK_SIZE):
+            pl.delete(*keys_chunk)
+        keys = [self._make_key(self.epochs_key_format),
+                self._make_key(self.epoch_names_key_format, epoch=epoch)]
+        # Registered scripts make pipeline check them with
+        # an extra round trip, redis caches evaluated script anyway
+        pl.eval(self.forget_epoch_script, len(keys), *(keys + [epoch]))
+        pl.execute()
+
+    @with_periodic_counter_lock
+    def update(self):
+        now_ts = timegm(datetime.utcnow().utctimetuple())
+        closed_epoch = self._get_epoch(now_ts - self.CLOSE_DELAY)
+        epochs_key = self._make_key(self.epochs_key_format)
+        prev_upd_key = self._make_key(self.prev_upd_key_format)
+        prev_upd = self.redis_db.get(prev_upd_key)
+        if prev_upd:
+            prev_upd = datetime.utcfromtimestamp(int(prev_upd))
+        # Forget epochs, which keys have already expired
+        oldest_epoch = closed_epoch - self.CATCHUP_HOURS * 60 // self.interval
+        self.redis_db.zremrangebyscore(epochs_key, '-inf', oldest_epoch)
+        epochs = self.redis_db.zrangebyscore(epochs_key, '-inf',
+                                             closed_epoch - 1)
+        log.debug(
+            "PeriodicCounter (collection: {collection}) "
+            "update was triggered, closed epochs: {epochs}".format(
+                collection=self.collection.name, epochs=epochs,
+            )
+        )
+        try:
+            # Epochs are stored one by one, so catching up after an outage
+            # doesn't keep docs of all missed intervals in memory
+            for epoch in map(int, epochs):
+                docs, keys = self._read_epoch(epoch)
+                # Doc of epoch written again after update is stored
+                late = prev_upd and self._get_epoch_date(epoch) <= prev_upd
+                if late:
+                    log.warning(
+                        "Dropped {} docs written after epoch {} was stored "
+                        "in {}".format(len(docs), epoch,
+                                       self.collection.name))
+                else:
+                    self._insert_docs(docs)
+                self._drop_epoch(epoch, keys)
+
+            now = self._get_epoch_date(closed_epoch - 1)
+            self.redis_db.set(prev_upd_key, timegm(now.utctimetuple()))
+
+            self._remove_old_docs(now)
+        except AutoReconnect as e:
+            log.warning("Failed to update counters: {}".format(e))
+
+
+class RollupPeriodicCounter(PeriodicCounter):
+    """
+    The PeriodicCounter, which isn't fed with stats, but derives its
+    docs from docs of a more accurate `source` periodic counter.
+    Counter has to be updated after its source, intervals are rolled up
+    only when the source has already stored all their data.
+
+    Parameters are the same as for `PeriodicCounter`, plus:
+      - 'source' -- periodic counter with smaller interval, which divides
+      interval of this counter
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.source = kwargs.pop('source')
+        super(RollupPeriodicCounter, self).__init__(*args, **kwargs)
+        if self.interval % self.source.interval:
+            raise ValueError("Source interval has to divide counter interval")
+
+    def _get_prev_upd(self, counter):
+        prev_upd_key = counter._make_key(counter.prev_upd_key_format)
+        prev_upd = self.redis_db.get(prev_upd_key)
+        if prev_upd:
+            return datetime.utcfromtimestamp(int(prev_upd))
+
+    def incrby(self, app_id, name, field, increment):
+        # Data is taken from the source counter
+        return
+
+    def _queue_incrby_bulk(self, pl, stats, now, scores):
+        # Data is taken from the source counter
+        return
+
+    def _rollup(self, date):
+        """
+        Return docs made by summing up source docs of interval ending at
+        `date`.
+        """
+        start = date - timedelta(minutes=self.interval)
+        docs = {}
+        for source_doc in self.source.iter_docs(start, date):
+            key = source_doc['app_id'], source_doc['name']
+            doc = docs.get(key)
+            if doc is None:
+                doc = dict.fromkeys(self.fields, 0.0)
+                doc.update(app_id=source_doc['app_id'],
+                           name=source_doc['name'], date=date)
+                docs[key] = doc
+            for field in self.fields:
+                doc[field] += source_doc.get(field) or 0.0
+            for field in self.hist_fields:
+                if source_doc.get(field):
+                    merge_hist(doc.setdefault(field, {}), source_doc[field])
+        return docs.values()
+
+    @with_periodic_counter_lock
+    def update(self):
+        prev_upd = self._get_prev_upd(self)
+        source_upd = self._get_prev_upd(self.source)
+        log.debug(
+            "PeriodicCounter (collection: {collection}) "
+            "rollup was triggered, previous update: {prev}, "
+            "source update: {source}".format(
+                collection=self.collection.name, prev=prev_upd,
+                source=source_upd,
+            )
+        )
+        if source_upd is None:
+            return
+
+        # Get current utc datetime rounded to interval
+        now = datetime.utcnow()
+        new_time = time(hour=now.hour,
+                        minute=((now.minute // self.interval) * self.interval))
+        now = datetime.combine(now.date(), new_time)
+        interval = timedelta(minutes=self.interval)
+        if prev_upd is None:
+            prev_upd = now - interval
+        # Source doesn't have data older than its period
+        oldest = now - timedelta(hours=self.source.period)
+        date = max(prev_upd, oldest) + interval
+
+        docs = []
+        last_date = None
+        while date <= min(now, source_upd):
+            docs.extend(self._rollup(date))
+            last_date = date
+            date += interval
+        if last_date is None:
+            # Too early, exiting
+            return
+
+        try:
+            self._insert_docs(docs)
+            prev_upd_key = self._make_key(self.prev_upd_key_format)
+            self.redis_db.set(prev_upd_key, timegm(last_date.utctimetuple()))
+
+            self._remove_old_docs(now)
+        except AutoReconnect as e:
+            log.warning("Failed to update counters: {}".format(e))
+
+
+def migrate_to_interned_keys(counter, chunk_size=1000):
+    """
+    Rename keys of `counter` made in plain layout (original app_ids,
+    names and fields) into keys made with counter's interner.
+    Stats must not be added while keys are migrated.
+    """
+    db = counter.interner.db
+    for app_id in counter._get_app_ids():
+        plain_key = counter._make_plain_key(counter.names_key_format,
+                                            app_id=app_id)
+        key = counter._make_key(counter.names_key_format, app_id=app_id)
+        if db.exists(plain_key):
+            db.rename(plain_key, key)
+        for names in chunks(counter._get_names(app_id), chunk_size):
+            renames = []
+            for name in names:
+                for field in counter.fields:
+                    for key_format in counter.field_key_formats:
+                        renames.append((
+                            counter._make_plain_key(key_format, app_id=app_id,
+                                                    name=name, field=field),
+                            counter._make_key(key_format, app_id=app_id,
+                                              name=name, field=field),
+                        ))
+            pl = db.pipeline()
+            for plain_key, _ in renames:
+                pl.exists(plain_key)
+            exist = pl.execute()
+            for (plain_key, key), key_exists in izip(renames, exist):
+                if key_exists:
+                    pl.rename(plain_key, key)
+            pl.execute()
+
+
+class CounterGroup(object):
+    """
+    Group of counters fed with the same statistics data.
+    `incrby_bulk` checks stats and computes registries timestamps once
+    and writes stats into all counters using a single pipeline.
+
+    Parameters:
+      - 'redis_db' -- redis db instance all counters work with
+      - 'counters' -- list of `RollingCounter` and `PeriodicCounter`
+      instances
+      - 'interner' -- `KeyInterner` instance used by counters
+      - 'guard' -- `CardinalityGuard` instance folding long tail names
+      of stats into a single one
+    """
+
+    def __init__(self, redis_db, counters, interner=None, guard=None):
+        self.redis_db = redis_db
+        self.counters = counters
+        self.interner = interner
+        self.guard = guard
+
+    def incrby_bulk(self, stats):
+        check_stats(stats)
+        pl = self.redis_db.pipeline()
+        if self.guard is not None:
+            # Guard is updated with all names in the same pipeline
+            guard_state = self.guard._queue_update(pl, stats)
+            num_guard_commands = len(pl)
+            stats = self.guard.filter(stats)
+        if self.interner is not None:
+            self.interner.intern_stats(stats)
+        now = timegm(datetime.utcnow().utctimetuple())
+        scores = registry_scores(stats, now)
+        for counter in self.counters:
+            counter._queue_incrby_bulk(pl, stats, now, scores)
+        results = pl.execute()
+        if self.guard is not None:
+            self.guard._read_update(guard_state, results[:num_guard_commands])
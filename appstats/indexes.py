@@ -0,0 +1,60 @@
+# encoding: utf-8
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+
+DOCS_PERIODS = ('hour', 'day', 'hour_aver', 'day_aver')
+
+
+def declare_indexes(periodic_counters, fields, events_ttl):
+    """
+    Return dict of collection names and lists of their indexes.
+
+    Parameters:
+      - 'periodic_counters' -- counters of all stats storing docs in mongo
+      - 'fields' -- keys of fields, docs tables can be sorted by
+      - 'events_ttl' -- seconds to keep events for
+    """
+    docs_indexes = [IndexModel([('app_id', ASCENDING), ('name', ASCENDING)],
+                               background=True)]
+    # Sort options of stats tables
+    for field in fields:
+        for period in DOCS_PERIODS:
+            sort_key = '%s_%s' % (field, period)
+            docs_indexes.append(IndexModel([('app_id', ASCENDING),
+                                            (sort_key, DESCENDING)],
+                                           background=True))
+    indexes = {
+        'appstats_docs': docs_indexes,
+        'appstats_tasks_docs': docs_indexes,
+        'anomalies': [
+            IndexModel([('app_id', ASCENDING), ('name', ASCENDING)],
+                       background=True),
+        ],
+        'appstats_events': [
+            IndexModel([('date', ASCENDING), ('app_id', ASCENDING)],
+                       background=True),
+            IndexModel([('date', ASCENDING)], background=True,
+                       expireAfterSeconds=events_ttl),
+        ],
+    }
+    for counter in periodic_counters:
+        indexes[counter.collection.name] = [
+            IndexModel([('app_id', ASCENDING), ('name', ASCENDING),
+                        ('date', ASCENDING)], background=True),
+            IndexModel([('date', ASCENDING)], background=True),
+        ]
+    return indexes
+
+
+def get_index_usage(collection):
+    """
+    Return dict of index names and numbers of operations used them
+    since server start, or None if server doesn't support $indexStats
+    (mongodb < 3.2).
+    """
+    try:
+        stats = collection.aggregate([{'$indexStats': {}}])
+    except OperationFailure:
+        return None
+    return {index['name']: index['accesses']['ops'] for index in stats}
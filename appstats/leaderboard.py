@@ -0,0 +1,147 @@
+# encoding: utf-8
+import os
+from time import time
+
+
+class Leaderboards(object):
+    """
+    Sorted sets of names for each app_id and sort key of cached docs
+    (e.g. 'NUMBER_hour', 'cpu_time_day_aver'), which give top names
+    without sorting docs collection.
+    Leaderboards are rebuilt in temporary keys and replace
+    previous ones at once, when all docs are added.
+    Between rebuilds, leaderboards of sums ('<field>_hour',
+    '<field>_day') are fed with incoming stats like counters, so new
+    and growing names get into them at once. Values leaving rolling
+    windows are dropped on the next rebuild.
+
+    Parameters:
+      - 'redis_db' -- redis db instance
+      - 'redis_prefix' -- prefix used in each redis key
+      - 'stats' -- name of statistics (apps or tasks)
+      - 'fields' -- field keys to build leaderboards for
+    """
+
+    PERIODS = ('hour', 'day', 'hour_aver', 'day_aver')
+    # Temporary keys of interrupted rebuild are left to expire
+    TMP_KEY_TTL = 3600
+    # Sort keys of sums, which can be incremented by incoming stats
+    SUM_PERIODS = ('hour', 'day')
+
+    key_format = '%(prefix)s,leaderboard,%(stats)s,%(app_id)s,%(sort_by)s'
+    apps_key_format = '%(prefix)s,leaderboard,%(stats)s,apps'
+
+    # Rename ARGV[1] pairs of temporary and leaderboard keys (KEYS[1..]),
+    # deleting leaderboards, which temporary keys have expired,
+    # and delete the rest of KEYS
+    replace_script = """
+        local num_pairs = tonumber(ARGV[1])
+        for i = 1, 2 * num_pairs, 2 do
+            if redis.call('EXISTS', KEYS[i]) == 1 then
+                redis.call('RENAME', KEYS[i], KEYS[i + 1])
+                -- Renamed key keeps ttl of temporary one
+                redis.call('PERSIST', KEYS[i + 1])
+            else
+                redis.call('DEL', KEYS[i + 1])
+            end
+        end
+        for i = 2 * num_pairs + 1, #KEYS do
+            redis.call('DEL', KEYS[i])
+        end
+    """
+
+    def __init__(self, redis_db, redis_prefix, stats, fields):
+        self.db = redis_db
+        self.prefix = redis_prefix
+        self.stats = stats
+        self.fields = fields
+        self.sort_keys = ['%s_%s' % (field, period)
+                          for field in fields for period in self.PERIODS]
+        self._rebuild_id = None
+        self._built = set()
+
+    def _make_key(self, app_id, sort_by):
+        return self.key_format % dict(prefix=self.prefix, stats=self.stats,
+                                      app_id=app_id, sort_by=sort_by)
+
+    def _make_tmp_key(self, app_id, sort_by):
+        return '%s,tmp,%s' % (self._make_key(app_id, sort_by),
+                              self._rebuild_id)
+
+    def add(self, docs):
+        """
+        Add cached docs into leaderboards being rebuilt.
+        """
+        if self._rebuild_id is None:
+            self._rebuild_id = '%d.%d' % (time() * 1000, os.getpid())
+            self._built = set()
+        scores = {}
+        for doc in docs:
+            for sort_by in self.sort_keys:
+                value = doc.get(sort_by)
+                if value is None:
+                    continue
+                key = doc['app_id'], sort_by
+                scores.setdefault(key, []).extend((value, doc['name']))
+        pl = self.db.pipeline(transaction=False)
+        for (app_id, sort_by), args in scores.iteritems():
+            tmp_key = self._make_tmp_key(app_id, sort_by)
+            pl.zadd(tmp_key, *args)
+            pl.expire(tmp_key, self.TMP_KEY_TTL)
+        pl.execute()
+        self._built.update(scores)
+
+    def replace(self):
+        """
+        Replace leaderboards by rebuilt ones.
+        Leaderboards, which got no docs, are deleted.
+        """
+        apps_key = self.apps_key_format % dict(prefix=self.prefix,
+                                               stats=self.stats)
+        app_ids = set(app_id for app_id, _ in self._built)
+        app_ids.update(self.db.smembers(apps_key))
+        pairs = []
+        deleted = []
+        for app_id in app_ids:
+            for sort_by in self.sort_keys:
+                key = self._make_key(app_id, sort_by)
+                if (app_id, sort_by) in self._built:
+                    pairs.extend((self._make_tmp_key(app_id, sort_by), key))
+                else:
+                    deleted.append(key)
+        pl = self.db.pipeline(transaction=True)
+        if pairs or deleted:
+            # Registered scripts make pipeline check them with
+            # an extra round trip, redis caches evaluated script anyway
+            keys = pairs + deleted
+            pl.eval(self.replace_script, len(keys),
+                    *(keys + [len(pairs) // 2]))
+        pl.delete(apps_key)
+        built_app_ids = set(app_id for app_id, _ in self._built)
+        if built_app_ids:
+            pl.sadd(apps_key, *built_app_ids)
+        pl.execute()
+        self._rebuild_id = None
+        self._built = set()
+
+    def _queue_incrby_bulk(self, pl, stats, now, scores):
+        """
+        Queue commands adding sums of `stats` into leaderboards,
+        so they can be fed by `CounterGroup`.
+        """
+        for app_id in stats:
+            for name, counts in stats[app_id].iteritems():
+                for field in self.fields:
+                    val = counts.get(field)
+                    if not val:
+                        continue
+                    for period in self.SUM_PERIODS:
+                        sort_by = '%s_%s' % (field, period)
+                        pl.zincrby(self._make_key(app_id, sort_by), name, val)
+
+    def get_top(self, app_id, sort_by, limit):
+        """
+        Return `limit` names with the highest `sort_by` values.
+        """
+        return self.db.zrevrange(self._make_key(app_id, sort_by),
+                                 0, limit - 1)
@@ -0,0 +1,134 @@
+# encoding: utf-8
+import os
+from time import time
+
+from .util import chunks
+
+
+def get_trigrams(value):
+    return set(value[i:i + 3] for i in xrange(len(value) - 2))
+
+
+class NamesIndex(object):
+    """
+    Trigram index of names for substring search, kept in redis sets
+    of names for each app_id and trigram. With `interner`, sets keep
+    interned ids of names instead, which are much shorter.
+    Index is rebuilt from cached docs as a new generation, which becomes
+    current when all docs are added. Keys of previous generation are
+    left to expire, so running searches can finish.
+
+    Parameters:
+      - 'redis_db' -- redis db instance
+      - 'redis_prefix' -- prefix used in each redis key
+      - 'stats' -- name of statistics (apps or tasks)
+      - 'interner' -- optional KeyInterner to store ids of names with
+    """
+
+    MIN_TERM_LENGTH = 3
+    # Index is dropped if it isn't rebuilt during this time
+    TTL = 24 * 3600
+    OLD_GENERATION_TTL = 60
+    CHUNK_SIZE = 1000
+
+    current_key_format = '%(prefix)s,names_index,%(stats)s'
+    trigrams_key_format = '%(prefix)s,names_index,%(stats)s,%(gen)s'
+    postings_key_format = ('%(prefix)s,names_index,%(stats)s,%(gen)s,'
+                           '%(app_id)s,%(trigram)s')
+
+    def __init__(self, redis_db, redis_prefix, stats, interner=None):
+        self.db = redis_db
+        self.prefix = redis_prefix
+        self.stats = stats
+        self.interner = interner
+        self._gen = None
+
+    def _make_key(self, key_format, **kwargs):
+        return key_format % dict(prefix=self.prefix, stats=self.stats,
+                                 **kwargs)
+
+    def add(self, docs):
+        """
+        Add names of cached docs into index generation being built.
+        """
+        if self._gen is None:
+            self._gen = '%d.%d' % (time() * 1000, os.getpid())
+        trigrams_key = self._make_key(self.trigrams_key_format, gen=self._gen)
+        if self.interner is not None:
+            docs = list(docs)
+            self.interner.intern('name', [doc['name'] for doc in docs])
+        postings = {}
+        for doc in docs:
+            name = doc['name']
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            if self.interner is None:
+                member = name
+            else:
+                member = self.interner.get_id('name', doc['name'])
+            for trigram in get_trigrams(name):
+                postings.setdefault((doc['app_id'], trigram),
+                                    []).append(member)
+        if not postings:
+            return
+        pl = self.db.pipeline(transaction=False)
+        for (app_id, trigram), names in postings.iteritems():
+            key = self._make_key(self.postings_key_format, gen=self._gen,
+                                 app_id=app_id, trigram=trigram)
+            pl.sadd(key, *names)
+            pl.expire(key, self.TTL)
+        pl.sadd(trigrams_key, *('%s,%s' % pair for pair in postings))
+        pl.expire(trigrams_key, self.TTL)
+        pl.execute()
+
+    def replace(self):
+        """
+        Make built generation current and expire the previous one.
+        """
+        current_key = self._make_key(self.current_key_format)
+        old_gen = self.db.get(current_key)
+        if self._gen is None:
+            self.db.delete(current_key)
+        else:
+            self.db.setex(current_key, self.TTL, self._gen)
+        self._gen = None
+        if old_gen is None:
+            return
+        trigrams_key = self._make_key(self.trigrams_key_format, gen=old_gen)
+        for pairs in chunks(self.db.sscan_iter(trigrams_key,
+                                               count=self.CHUNK_SIZE),
+                            self.CHUNK_SIZE):
+            pl = self.db.pipeline(transaction=False)
+            for pair in pairs:
+                app_id, trigram = pair.split(',', 1)
+                key = self._make_key(self.postings_key_format, gen=old_gen,
+                                     app_id=app_id, trigram=trigram)
+                pl.expire(key, self.OLD_GENERATION_TTL)
+            pl.execute()
+        self.db.expire(trigrams_key, self.OLD_GENERATION_TTL)
+
+    def search(self, app_id, term):
+        """
+        Return set of names containing `term`
+        or None if index can't be used for it.
+        """
+        if isinstance(term, unicode):
+            term = term.encode('utf-8')
+        if isinstance(app_id, unicode):
+            app_id = app_id.encode('utf-8')
+        if len(term) < self.MIN_TERM_LENGTH:
+            return None
+        gen = self.db.get(self._make_key(self.current_key_format))
+        if gen is None:
+            return None
+        keys = [self._make_key(self.postings_key_format, gen=gen,
+                               app_id=app_id, trigram=trigram)
+                for trigram in get_trigrams(term)]
+        names = self.db.sinter(keys)
+        if self.interner is not None:
+            # Ids of names removed from interner have no names
+            names = [name for name in self.interner.get_values('name',
+                                                                list(names))
+                     if name is not None]
+        # Names having all trigrams of term may still not contain it
+        return set(name.decode('utf-8') for name in names if term in name)
@@ -0,0 +1,99 @@
+# encoding: utf-8
+import math
+import socket
+import logging
+
+from .util import merge_stats, hist_bucket, HIST_SUFFIX
+
+
+log = logging.getLogger(__name__)
+
+MAX_DATAGRAM_SIZE = 65535
+
+
+def parse_line(line, histograms=()):
+    """
+    Return `(app_id, name, counts)` of datagram line
+    'app_id|name|field:value[|field:value...]'
+    or None if line is malformed.
+    Each line is a single observation: NUMBER is 1 unless it's sent,
+    values of `histograms` fields are also counted in their histograms.
+    """
+    try:
+        parts = line.decode('utf-8').strip().split(u'|')
+    except UnicodeDecodeError:
+        return None
+    if len(parts) < 3:
+        return None
+    app_id, name = parts[0], parts[1]
+    # Names with commas would make the whole flush fail in check_stats
+    if not app_id or not name or u',' in app_id or u',' in name:
+        return None
+    counts = {}
+    for pair in parts[2:]:
+        # Field keys may contain colons (e.g. 'sql:duration')
+        field, _, value = pair.rpartition(u':')
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+        if not field or math.isinf(value) or math.isnan(value):
+            return None
+        # Histograms are made of observed values only
+        if field.endswith(HIST_SUFFIX):
+            return None
+        counts[field] = counts.get(field, 0.0) + value
+        if field in histograms:
+            hist = counts.setdefault(field + HIST_SUFFIX, {})
+            bucket = hist_bucket(value)
+            hist[bucket] = hist.get(bucket, 0) + 1
+    counts.setdefault(u'NUMBER', 1.0)
+    return app_id, name, counts
+
+
+def parse_datagram(data, histograms=()):
+    """
+    Return stats dict of all well-formed lines of datagram `data`
+    and number of malformed lines.
+    """
+    stats = {}
+    malformed = 0
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        parsed = parse_line(line, histograms)
+        if parsed is None:
+            malformed += 1
+            continue
+        app_id, name, counts = parsed
+        merge_stats(stats, {app_id: {name: counts}})
+    return stats, malformed
+
+
+def serve(address, add_func, histograms=()):
+    """
+    Receive stats datagrams on UDP `address` forever, passing stats
+    of each one to `add_func`.
+
+    Parameters:
+      - 'address' -- (host, port) tuple to bind to
+      - 'add_func' -- function to aggregate stats with
+      - 'histograms' -- fields to count histograms of
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    log.info("Listening for stats on udp {}:{}".format(*address))
+    try:
+        while True:
+            data = sock.recv(MAX_DATAGRAM_SIZE)
+            try:
+                stats, malformed = parse_datagram(data, histograms)
+                if malformed:
+                    log.debug("Skipped {} malformed lines".format(malformed))
+                if stats:
+                    add_func(stats)
+            except Exception:
+                log.exception("Failed to add received stats")
+    finally:
+        sock.close()
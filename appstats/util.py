@@ -1,5 +1,8 @@
 # encoding: utf-8
+import math
+import zlib
 import logging
+from itertools import izip
 from contextlib import contextmanager
 
 from time import mktime, time
@@ -12,6 +15,17 @@ from flask import request, url_for
 
 log = logging.getLogger(__name__)
 
+# Histograms are kept as counts of values in logarithmic buckets,
+# stats have them in '<field>:hist' fields.
+# appstats_client.py uses the same buckets.
+HIST_SUFFIX = ':hist'
+HIST_GAMMA = 1.1
+HIST_MIN_VALUE = 1e-6
+
+CHART_QUANTILES = (0.5, 0.95, 0.99)
+# Version of cached chart series format
+CHART_SERIES_VERSION = 2
+
 
 def current_url(**updates):
     kwargs = request.view_args.copy()
@@ -20,26 +34,26 @@ def current_url(**updates):
     return url_for(request.endpoint, **kwargs)
 
 
-def get_chart_info(periodic_counters, time_fields, app_id, name, hours, anomalies_coll=None):
-    def date_to_timestamp(date):
-        date = date.replace(tzinfo=pytz.utc)
-        return mktime(date.timetuple()) * 1000
+def date_to_timestamp(date):
+    date = date.replace(tzinfo=pytz.utc)
+    return mktime(date.timetuple()) * 1000
 
-    # Starting datetime of needed data
-    starting_from = datetime.utcnow() - timedelta(hours=hours)
-    # Choosing the most suitable, accurate counter based on given hours
-    counter = None
+
+def get_chart_counter(periodic_counters, hours):
+    """ Choose the most suitable, accurate counter based on given hours """
     for periodic_counter in periodic_counters:
         if hours <= periodic_counter.period:
-            counter = periodic_counter
-            break
+            return periodic_counter
     # If there isn't suitable counter,
     # take the last one (contains the most full data)
-    if not counter:
-        counter = periodic_counters[-1]
-    docs = counter.collection.find({'app_id': app_id, 'name': name,
-                                    'date': {'$gt': starting_from}})
-    docs = list(docs.sort('date'))
+    return periodic_counters[-1]
+
+
+def get_chart_series(counter, time_fields, app_id, name, hours):
+    # Starting datetime of needed data
+    starting_from = datetime.utcnow() - timedelta(hours=hours)
+    docs = list(counter.iter_docs(starting_from,
+                                  query={'app_id': app_id, 'name': name}))
     # Prepare list of rows for each time_field
     time_data = [[] for _ in time_fields]
     num_data = []
@@ -47,9 +61,9 @@ def get_chart_info(periodic_counters, time_fields, app_id, name, hours, anomalie
     if not docs:
         date = date_to_timestamp(datetime.utcnow())
         num_data = [[date, 0]]
-        time_data = [[[date, 0]]]
-        anomalies_data = []
-        return num_data, time_data, anomalies_data
+        time_data = [[[date, 0]] for _ in time_fields]
+        return num_data, time_data, []
+    hists = {}
     # For each doc localize date, transform timestamp from seconds to
     # milliseconds and append list [date, value] to data
     for doc in docs:
@@ -68,72 +82,284 @@ def get_chart_info(periodic_counters, time_fields, app_id, name, hours, anomalie
             key = time_field['key']
             value = doc.get(key, 0)
             time_data[i].append([date, float(value) / doc['NUMBER'] * 1000])
+            hist = doc.get(key + HIST_SUFFIX)
+            if hist:
+                merge_hist(hists.setdefault(key, {}), hist)
+
+    # Quantiles of time fields having histograms, in milliseconds
+    quantiles = []
+    for time_field in time_fields:
+        if time_field['key'] in hists:
+            values = hist_quantiles(hists[time_field['key']],
+                                    CHART_QUANTILES)
+            quantiles.append([time_field['name'],
+                              [value * 1000 for value in values]])
+    return num_data, time_data, quantiles
+
+
+def downsample_lttb(points, max_points, keep=()):
+    """
+    Reduce series of [date, value] points to about `max_points` using
+    Largest-Triangle-Three-Buckets algorithm, which keeps visual peaks.
+    Missing values (None) count as zero when choosing points.
+
+    Parameters:
+      - 'points' -- list of [date, value] sorted by date
+      - 'max_points' -- number of points to keep
+      - 'keep' -- set of dates, points on which are always kept
+    """
+    if max_points < 3 or len(points) <= max_points:
+        return points
+    def value(point):
+        return point[1] or 0
+
+    selected = [points[0]]
+    # First and last points are kept, the rest is split into buckets
+    bucket_size = float(len(points) - 2) / (max_points - 2)
+    prev = points[0]
+    for i in xrange(max_points - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        # Third vertex is the average point of the next bucket
+        next_bucket = points[end:int((i + 2) * bucket_size) + 1] or points[-1:]
+        avg_x = sum(p[0] for p in next_bucket) / float(len(next_bucket))
+        avg_y = sum(value(p) for p in next_bucket) / float(len(next_bucket))
+        max_area = -1
+        best = None
+        for point in points[start:end]:
+            area = abs((prev[0] - avg_x) * (value(point) - value(prev)) -
+                       (prev[0] - point[0]) * (avg_y - value(prev)))
+            if area > max_area:
+                max_area = area
+                best = point
+        selected.append(best)
+        prev = best
+    selected.append(points[-1])
+    if keep:
+        selected_dates = set(p[0] for p in selected)
+        kept = [p for p in points
+                if p[0] in keep and p[0] not in selected_dates]
+        if kept:
+            selected = sorted(selected + kept, key=lambda p: p[0])
+    return selected
+
+
+def get_chart_info(periodic_counters, time_fields, app_id, name, hours,
+                   anomalies_coll=None, cache=None):
+    counter = get_chart_counter(periodic_counters, hours)
+    if cache is not None:
+        # Series change only when counter stores new docs
+        key = (CHART_SERIES_VERSION, counter.collection.name, app_id, name,
+               hours, counter.get_last_update())
+        series = cache.get(key)
+        if series is None:
+            series = get_chart_series(counter, time_fields,
+                                      app_id, name, hours)
+            cache.set(key, series)
+    else:
+        series = get_chart_series(counter, time_fields, app_id, name, hours)
+    num_data, time_data, quantiles = series
 
     if anomalies_coll:
-        try:
-            anomalies = next(anomalies_coll.find({'name': name, 'app_id': app_id}))
-            anomalies = anomalies['anomalies']
-        except StopIteration:
-            anomalies = []
-        anomalies_data = map(date_to_timestamp, anomalies)
+        # Name may have docs of both batch detection and online scorer
+        anomalies = set()
+        for doc in anomalies_coll.find({'name': name, 'app_id': app_id}):
+            anomalies.update(doc['anomalies'])
+        anomalies_data = map(date_to_timestamp, sorted(anomalies))
     else:
         anomalies_data = []
-    return num_data, time_data, anomalies_data
-
-
-def calc_aver_data(data, interval):
-    """ Calculate average data based on ``interval`` """
-    aver_data = {}
-    for app_id in data:
-        aver_data[app_id] = {}
-        for name, counts in data[app_id].iteritems():
-            req_count = counts['NUMBER']
-            aver_counts = {}
-            if req_count == 0:
-                for field in counts:
-                    aver_counts[field] = None
-                continue
-            for field in counts:
-                if field == 'NUMBER':
-                    # insert requests per second
-                    aver_counts[field] = float(counts[field]) / interval
+    return num_data, time_data, anomalies_data, quantiles
+
+
+def make_columnar_series(num_data, time_data, anomalies_data,
+                         max_points=None):
+    """
+    Return chart data as columns sharing one list of dates. Dates are
+    delta encoded: the first one is absolute, others are differences
+    from the previous one.
+
+    Parameters:
+      - 'num_data', 'time_data', 'anomalies_data' -- result of
+      `get_chart_info`
+      - 'max_points' -- number of dates all series are downsampled to
+    """
+    rows = [dict(row) for row in [num_data] + time_data]
+    dates = [point[0] for point in num_data]
+    if max_points and len(dates) > max_points:
+        # Dates are chosen once for all series, on the largest relative
+        # deviation from its mean any series has at each date, so peaks
+        # of every series remain and kept anomalies don't exceed
+        # `max_points`
+        keep = set(anomalies_data).intersection(dates)
+        scales = []
+        for values in rows:
+            present = [v for v in values.itervalues() if v is not None]
+            mean = sum(present) / len(present) if present else 0.0
+            scale = max([abs(v - mean) for v in present] or [0.0]) or 1.0
+            scales.append((mean, scale))
+        combined = []
+        for date in dates:
+            shares = [abs(values[date] - mean) / scale
+                      for values, (mean, scale) in izip(rows, scales)
+                      if values.get(date) is not None]
+            combined.append([date, max(shares) if shares else None])
+        selected = downsample_lttb(combined, max(max_points - len(keep), 3),
+                                   keep)
+        dates = [point[0] for point in selected]
+    columns = []
+    for values in rows:
+        columns.append([None if values.get(d) is None
+                        else round(values[d], 3) for d in dates])
+    timestamps = [int(date) for date in dates]
+    deltas = [b - a for a, b in izip(timestamps, timestamps[1:])]
+    return {'timestamps': timestamps[:1] + deltas,
+            'rate': columns[0],
+            'timings': columns[1:],
+            'anomalies': [int(date) for date in anomalies_data]}
+
+
+def gzip_response(response, min_size=512):
+    """
+    Compress response body with gzip if client accepts it.
+    """
+    response.headers.add('Vary', 'Accept-Encoding')
+    if (not request.accept_encodings['gzip'] or
+            response.status_code != 200 or
+            len(response.data) < min_size):
+        return response
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    response.data = compressor.compress(response.data) + compressor.flush()
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def calc_aver_counts(counts, interval):
+    """
+    Calculate average counts based on ``interval``.
+    Return None if there were no requests.
+    """
+    req_count = counts['NUMBER']
+    if req_count == 0:
+        return None
+    aver_counts = {}
+    for field in counts:
+        if field == 'NUMBER':
+            # insert requests per second
+            aver_counts[field] = float(counts[field]) / interval
+        else:
+            aver_counts[field] = counts[field] / req_count
+    return aver_counts
+
+
+def make_flat_doc(app_id, name, hour_counts, day_counts,
+                  hour_interval, day_interval, fields):
+    """ Transform counts of one name into flat form """
+    doc = dict(app_id=app_id, name=name)
+    for period, counts, interval in (('hour', hour_counts, hour_interval),
+                                     ('day', day_counts, day_interval)):
+        aver_counts = calc_aver_counts(counts, interval)
+        for field in fields:
+            doc['%s_%s' % (field, period)] = counts[field]
+            if aver_counts is not None:
+                doc['%s_%s_aver' % (field, period)] = aver_counts[field]
+    return doc
+
+
+def merge_stats(dst, src):
+    """
+    Add counts of ``src`` stats to ``dst`` stats.
+    Return number of names, which were new for ``dst``.
+    """
+    new_names = 0
+    for app_id, names in src.iteritems():
+        dst_names = dst.setdefault(app_id, {})
+        for name, counts in names.iteritems():
+            dst_counts = dst_names.get(name)
+            if dst_counts is None:
+                dst_counts = dst_names[name] = {}
+                new_names += 1
+            for field, val in counts.iteritems():
+                if isinstance(val, dict):
+                    merge_hist(dst_counts.setdefault(field, {}), val)
                 else:
-                    aver_counts[field] = counts[field] / req_count
-            aver_data[app_id][name] = aver_counts
-    return aver_data
-
-
-def data_to_flat_form(hour_data, hour_aver_data,
-                      day_data, day_aver_data, fields):
-    """ Transform data into flat form """
-    docs = {}
-
-    for app_id in hour_data:
-        for name in hour_data[app_id]:
-            doc = docs.setdefault((app_id, name), dict(app_id=app_id, name=name))
-            for field in fields:
-                key = '%s_%s' % (field, 'hour')
-                doc[key] = hour_data[app_id][name][field]
-
-        for name in hour_aver_data[app_id]:
-            doc = docs.setdefault((app_id, name), dict(app_id=app_id, name=name))
-            for field in fields:
-                key = '%s_%s' % (field, 'hour_aver')
-                doc[key] = hour_aver_data[app_id][name][field]
-
-    for app_id in day_data:
-        for name in day_data[app_id]:
-            doc = docs.setdefault((app_id, name), dict(app_id=app_id, name=name))
-            for field in fields:
-                key = '%s_%s' % (field, 'day')
-                doc[key] = day_data[app_id][name][field]
-
-        for name in day_aver_data[app_id]:
-            doc = docs.setdefault((app_id, name), dict(app_id=app_id, name=name))
-            for field in fields:
-                key = '%s_%s' % (field, 'day_aver')
-                doc[key] = day_aver_data[app_id][name][field]
-    return docs
+                    dst_counts[field] = dst_counts.get(field, 0) + val
+    return new_names
+
+
+def hist_bucket(value):
+    """
+    Return bucket of histogram (as string) containing `value`.
+    Bucket `i` holds values in (HIST_GAMMA ** (i - 1), HIST_GAMMA ** i].
+    """
+    value = max(value, HIST_MIN_VALUE)
+    return str(int(math.ceil(math.log(value) / math.log(HIST_GAMMA))))
+
+
+def is_number(value):
+    """
+    Return True if `value` is a finite int, long or float (not bool).
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        return False
+    return not (math.isinf(value) or math.isnan(value))
+
+
+def check_hist(hist):
+    """
+    Raise ValueError if `hist` isn't a dict of integer buckets (as
+    strings) and finite non-negative counts.
+    """
+    if not isinstance(hist, dict):
+        raise ValueError("Histogram has to be a dict of bucket counts")
+    for bucket, count in hist.iteritems():
+        try:
+            int(bucket)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid histogram bucket: {!r}".format(bucket))
+        if not is_number(count) or count < 0:
+            raise ValueError("Invalid histogram count: {!r}".format(count))
+
+
+def merge_hist(dst, src):
+    """ Add counts of ``src`` histogram to ``dst`` histogram """
+    for bucket, count in src.iteritems():
+        dst[bucket] = dst.get(bucket, 0) + count
+    return dst
+
+
+def hist_quantiles(hist, quantiles):
+    """
+    Return list of values of `quantiles` (0.0 -- 1.0) estimated
+    by histogram with relative error of (HIST_GAMMA - 1) / 2.
+    """
+    buckets = sorted((int(bucket), count)
+                     for bucket, count in hist.iteritems() if count > 0)
+    total = sum(count for _, count in buckets)
+    if not total:
+        return [None] * len(quantiles)
+    values = []
+    for quantile in quantiles:
+        rank = quantile * total
+        seen = 0
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                break
+        # Middle of bucket
+        values.append(2 * HIST_GAMMA ** bucket / (HIST_GAMMA + 1))
+    return values
+
+
+def chunks(iterable, size):
+    """ Split ``iterable`` into lists of ``size`` items """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def log_time_call(log_level=logging.DEBUG):
@@ -1,53 +1,242 @@
+import os
 import json
+import atexit
+import math
+import zlib
 import logging
 import threading
 from time import time
-from collections import defaultdict, Counter
+from itertools import count
+from collections import defaultdict, deque, Counter
 
 from requests import Session, RequestException
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 log = logging.getLogger(__name__)
 
-lock = threading.Lock()
+JSON_CONTENT_TYPE = 'application/json'
+COMPACT_CONTENT_TYPE = 'application/x-appstats-msgpack'
+
+# Histogram buckets, the same as in appstats.util
+HIST_GAMMA = 1.1
+HIST_MIN_VALUE = 1e-6
+
+
+def hist_bucket(value):
+    value = max(value, HIST_MIN_VALUE)
+    return str(int(math.ceil(math.log(value) / math.log(HIST_GAMMA))))
+
+
+def encode_compact(stats):
+    # The same as appstats.codec.encode_compact
+    fields = []
+    indexes = {}
+    compact_stats = {}
+    for app_id, names in stats.iteritems():
+        compact_names = compact_stats[app_id] = {}
+        for name, counts in names.iteritems():
+            values = compact_names[name] = []
+            for field, val in counts.iteritems():
+                index = indexes.get(field)
+                if index is None:
+                    index = indexes[field] = len(fields)
+                    fields.append(field)
+                values.extend((index, val))
+    return msgpack.packb([fields, compact_stats])
+
+
+def merge_acc(dst, src):
+    for name, counts in src.iteritems():
+        dst_counts = dst[name]
+        for counter, val in counts.iteritems():
+            if isinstance(val, Counter):
+                dst_counts.setdefault(counter, Counter()).update(val)
+            else:
+                dst_counts[counter] += val
+
+
+class _Shard(object):
+    """
+    Accumulator updated by a single thread. Its lock is taken only by
+    the thread and by flushes, so it's never contended by other adds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = threading.current_thread()
+        self.acc = defaultdict(Counter)
 
 
 class AppStatsClient(object):
     limit = 100 # records
     interval = 60 # seconds
     timeout = 1 # timeout in seconds to submit data
+    queue_size = 10 # batches waiting for submission, the oldest are dropped
 
-    def __init__(self, url, app_id):
+    def __init__(self, url, app_id, histograms=(), compact=False,
+                 compress=False):
         self.url = url
         self.app_id = app_id
-        self._acc = defaultdict(Counter)
+        # Fields to send histograms of, e.g. ('real_time',)
+        self.histograms = histograms
+        # Send msgpack with field indexes instead of JSON (needs msgpack)
+        if compact and msgpack is None:
+            raise ImportError("msgpack is required for compact format")
+        self.compact = compact
+        # Gzip submitted data
+        self.compress = compress
+        self._lock = threading.Lock()
+        # Each thread adds into its own shard, shards are merged on flush
+        self._local = threading.local()
+        self._shards = []
         self._last_sent = time()
+        headers = {'Content-Type': (COMPACT_CONTENT_TYPE if compact
+                                    else JSON_CONTENT_TYPE)}
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
         self._session = Session(
-            headers = {'Content-Type': 'application/json'},
+            headers = headers,
             timeout = self.timeout,
         )
-        self._req_count = 0
+        # Incremented without lock, next() is atomic
+        self._req_count = count(1)
+        # Data is submitted by a daemon thread, so add() never waits for it
+        self._queue = deque(maxlen=self.queue_size)
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def _ensure_thread(self):
+        # Thread is started lazily, so it is alive in forked workers
+        if self._pid == os.getpid() or self._closed:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='appstats-client')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _get_shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+        return shard
 
     def add(self, name, counts):
-        with lock:
-            self._acc[name]['NUMBER'] += 1
+        self._ensure_thread()
+        shard = self._get_shard()
+        with shard.lock:
+            acc = shard.acc[name]
+            acc['NUMBER'] += 1
             for counter in counts:
-                self._acc[name][counter] += counts[counter]
-            self._req_count += 1
-
-            elapsed = time() - self._last_sent
-            if elapsed >= self.interval or self._req_count >= self.limit:
+                acc[counter] += counts[counter]
+            for counter in self.histograms:
+                if counter in counts:
+                    hist = acc.setdefault(counter + ':hist', Counter())
+                    hist[hist_bucket(counts[counter])] += 1
+        if next(self._req_count) >= self.limit:
+            if self._closed:
                 self.submit()
+            else:
+                self._wakeup.set()
 
-    def submit(self):
-        data = json.dumps({self.app_id: self._acc})
+    def _collect(self):
+        """
+        Return data accumulated by all threads, emptying their shards.
+        Shards of finished threads are forgotten.
+        Must be called with `_lock` held.
+        """
+        accs = []
+        alive = []
+        for shard in self._shards:
+            with shard.lock:
+                if shard.acc:
+                    accs.append(shard.acc)
+                    shard.acc = defaultdict(Counter)
+            if shard.thread.is_alive():
+                alive.append(shard)
+        self._shards = alive
+        if len(accs) == 1:
+            return accs[0]
+        acc = defaultdict(Counter)
+        for shard_acc in accs:
+            merge_acc(acc, shard_acc)
+        return acc
+
+    def _enqueue(self):
+        """
+        Move accumulated data into submission queue.
+        Must be called with `_lock` held.
+        """
+        self._req_count = count(1)
+        self._last_sent = time()
+        acc = self._collect()
+        if acc:
+            if len(self._queue) == self._queue.maxlen:
+                log.debug('Submission queue is full, dropping oldest data')
+            self._queue.append(acc)
+
+    def _run(self):
+        while not self._closed:
+            # Thread is woken when the limit is reached
+            full = self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            with self._lock:
+                if full or time() - self._last_sent >= self.interval:
+                    self._enqueue()
+            self._submit_queued()
+
+    def _submit_queued(self):
+        while True:
+            try:
+                acc = self._queue.popleft()
+            except IndexError:
+                break
+            self._post(acc)
+
+    def _post(self, acc):
+        if self.compact:
+            data = encode_compact({self.app_id: acc})
+        else:
+            data = json.dumps({self.app_id: acc})
+        if self.compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
         try:
             self._session.post(self.url, data=data)
         except RequestException, e:
             log.debug('Error during data submission: %s' % e)
         else:
             log.debug('Successfully submitted app stats')
-        finally:
-            self._last_sent = time()
-            self._acc = defaultdict(Counter)
-            self._req_count = 0
+
+    def submit(self):
+        """
+        Submit accumulated and queued data from the calling thread.
+        """
+        with self._lock:
+            self._enqueue()
+        self._submit_queued()
+
+    def close(self):
+        """
+        Stop background thread and submit everything accumulated.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.timeout * 2)
+        self.submit()
@@ -6,21 +6,36 @@ from email.header import Header
 from email.mime.text import MIMEText
 
 from smtplib import SMTP
+from hashlib import md5
+from multiprocessing import Pool
 from datetime import datetime, timedelta, date
 
 from flaskext.script import Manager
-from pymongo import ASCENDING
+from pymongo import ReplaceOne, DeleteOne
 
 from appstats.app import app, apps_last_hour_counter, apps_last_day_counter
 from appstats.app import tasks_last_hour_counter, tasks_last_day_counter
 from appstats.app import apps_periodic_counters, tasks_periodic_counters
 from appstats.app import apps_counters, tasks_counters
 from appstats.app import REDIS_PREFIX, redis_db, mongo_db, fields
+from appstats.app import visible_fields
+from appstats.app import key_interner
+from appstats.app import apps_counter_group, tasks_counter_group
+from appstats.app import HISTOGRAM_FIELDS
+from appstats.app import apps_leaderboards, tasks_leaderboards
+from appstats.app import apps_names_index, tasks_names_index
+from appstats.counter import migrate_to_interned_keys
+from appstats.indexes import declare_indexes, get_index_usage
+from appstats.anomaly import find_app_anomalies, BATCH_SOURCE, SCORER_SOURCE
+from appstats.coalescer import StatsCoalescer
+from appstats import udp
 
-from appstats.util import calc_aver_data, data_to_flat_form, log_time_call
+from appstats.util import make_flat_doc, log_time_call, chunks
 
 manager = Manager(app)
 
+CACHE_CHUNK_SIZE = 1000
+
 
 @manager.option('-d', '--days', dest='days', type=int, default=182)
 @manager.option('-s', '--stats', required=True, dest='stats',
@@ -39,8 +54,11 @@ def strip_db(days, stats):
 @manager.command
 def clear():
     """ Delete all data from redis and mongo dbs. """
-    # Flush all redis records with appstats prefix
-    keys = redis_db.keys('%s*' % REDIS_PREFIX)
+    # Flush all redis records with appstats prefix, except interned ids:
+    # running processes cache them and would keep using the old ones
+    interned_prefix = '%s,interned,' % REDIS_PREFIX
+    keys = [key for key in redis_db.keys('%s*' % REDIS_PREFIX)
+            if not key.startswith(interned_prefix)]
     if keys:
         redis_db.delete(*keys)
     # Drop mongo 'cache' collection
@@ -53,6 +71,66 @@ def clear():
         mongo_db.drop_collection(periodic_counter.collection)
 
 
+@manager.command
+@log_time_call(logging.INFO)
+def migrate_keys():
+    """ Move redis data of all counters into compact keys layout. """
+    if key_interner is None:
+        print 'COMPACT_KEYS setting is disabled'
+        return
+    for counter in apps_counters + tasks_counters:
+        migrate_to_interned_keys(counter)
+
+
+@manager.option('-n', '--dry-run', dest='dry_run', action='store_true',
+                default=False, help='Only report state of indexes')
+@log_time_call(logging.INFO)
+def migrate_indexes(dry_run):
+    """
+    Build missing indexes of all collections in background
+    and report undeclared and unused ones.
+    """
+    indexes = declare_indexes(apps_periodic_counters + tasks_periodic_counters,
+                              [f['key'] for f in visible_fields],
+                              app.config['EVENTS_TTL_DAYS'] * 24 * 3600)
+    for collection_name, models in sorted(indexes.iteritems()):
+        collection = mongo_db[collection_name]
+        existing = collection.index_information()
+        declared = set()
+        missing = []
+        for model in models:
+            index = model.document
+            declared.add(index['name'])
+            if index['name'] not in existing:
+                missing.append(model)
+                print '%s: missing %s' % (collection_name, index['name'])
+                continue
+            ttl = index.get('expireAfterSeconds')
+            old_ttl = existing[index['name']].get('expireAfterSeconds')
+            if ttl == old_ttl:
+                continue
+            if ttl is None or old_ttl is None:
+                print '%s: %s has different options, drop it to rebuild' % (
+                    collection_name, index['name'])
+            elif not dry_run:
+                print '%s: changing ttl of %s' % (collection_name,
+                                                  index['name'])
+                mongo_db.command('collMod', collection_name,
+                                 index={'keyPattern': index['key'],
+                                        'expireAfterSeconds': ttl})
+        if missing and not dry_run:
+            collection.create_indexes(missing)
+
+        usage = get_index_usage(collection) or {}
+        for name in sorted(existing):
+            if name == '_id_':
+                continue
+            if name not in declared:
+                print '%s: undeclared %s' % (collection_name, name)
+            if usage.get(name) == 0:
+                print '%s: unused %s' % (collection_name, name)
+
+
 @manager.option('-s', '--stats', required=True, dest='stats',
                 choices=['apps', 'tasks'], help='Statistics to update')
 @log_time_call(logging.INFO)
@@ -60,50 +138,159 @@ def update_counters(stats):
     """ Update all counters """
     if stats == 'apps':
         counters = apps_counters
-        periodic_counters = apps_periodic_counters
     elif stats == 'tasks':
         counters = tasks_counters
-        periodic_counters = tasks_periodic_counters
-    # Ensuring indexes
-    for counter in periodic_counters:
-        counter.collection.ensure_index([('app_id', ASCENDING),
-                                         ('name', ASCENDING),
-                                         ('date', ASCENDING)],
-                                        cache_for=3600)
-        counter.collection.ensure_index('date', cache_for=3600)
     for counter in counters:
         counter.update()
+    # Ids of names, which left registries of all counters, aren't used
+    if key_interner is not None:
+        key_interner.prune()
+
+
+def iter_cache_docs(last_hour_counter, last_day_counter, indexes=()):
+    """
+    Yield lists of flat docs made of rolling counters data.
+    Indexes (leaderboards, names index) are rebuilt of them,
+    when all docs are read.
+    """
+    # Both counters are always updated together, so it's enough
+    # to iterate over names of the day counter only.
+    for app_id, names, day_counts in last_day_counter.iter_chunks():
+        hour_counts = last_hour_counter.get_counts(app_id, names)
+        docs = [make_flat_doc(app_id, name, hour, day,
+                              last_hour_counter.interval,
+                              last_day_counter.interval,
+                              last_hour_counter.fields)
+                for name, hour, day in zip(names, hour_counts, day_counts)]
+        for index in indexes:
+            index.add(docs)
+        yield docs
+    for index in indexes:
+        index.replace()
+
+
+def doc_digest(doc):
+    return md5(repr(sorted(doc.iteritems()))).hexdigest()
+
+
+def update_cache_incrementally(collection, docs_chunks):
+    """
+    Write only docs changed since the previous run and delete docs of
+    names, which dropped out of counters. Digests of written docs are
+    kept in redis hash, which is replaced at the end of each run.
+    """
+    digests_key = '%s,cache_digests,%s' % (REDIS_PREFIX, collection.name)
+    new_digests_key = '%s,new' % digests_key
+    redis_db.delete(new_digests_key)
+    # Without digests there is no way to know, which docs are outdated
+    first_run = not redis_db.exists(digests_key)
+
+    for docs in docs_chunks:
+        ids = ['%s,%s' % (doc['app_id'], doc['name']) for doc in docs]
+        digests = map(doc_digest, docs)
+        old_digests = redis_db.hmget(digests_key, ids) if ids else []
+        requests = [ReplaceOne({'app_id': doc['app_id'],
+                                'name': doc['name']}, doc, upsert=True)
+                    for doc, digest, old_digest
+                    in zip(docs, digests, old_digests)
+                    if digest != old_digest]
+        if requests:
+            collection.bulk_write(requests, ordered=False)
+        if ids:
+            redis_db.hmset(new_digests_key, dict(zip(ids, digests)))
 
+    # Find docs of names, which are absent in counters now
+    if first_run:
+        ids_chunks = chunks(('%s,%s' % (doc['app_id'], doc['name'])
+                             for doc in collection.find(
+                                 projection={'app_id': 1, 'name': 1,
+                                             '_id': 0})),
+                            CACHE_CHUNK_SIZE)
+    else:
+        ids_chunks = chunks((id_ for id_, _ in
+                             redis_db.hscan_iter(digests_key,
+                                                 count=CACHE_CHUNK_SIZE)),
+                            CACHE_CHUNK_SIZE)
+    for ids in ids_chunks:
+        pl = redis_db.pipeline(transaction=False)
+        for id_ in ids:
+            pl.hexists(new_digests_key, id_)
+        requests = [DeleteOne(dict(zip(('app_id', 'name'),
+                                       id_.split(',', 1))))
+                    for id_, exists in zip(ids, pl.execute()) if not exists]
+        if requests:
+            collection.bulk_write(requests, ordered=False)
+
+    if redis_db.exists(new_digests_key):
+        redis_db.rename(new_digests_key, digests_key)
+    else:
+        redis_db.delete(digests_key)
 
+
+@manager.option('-i', '--incremental', dest='incremental',
+                action='store_true', default=False,
+                help='Write only changed docs instead of replacing all')
 @manager.option('-s', '--stats', required=True, dest='stats',
                 choices=['apps', 'tasks'], help='Statistics to update')
 @log_time_call(logging.INFO)
-def update_cache(stats):
+def update_cache(stats, incremental):
     """ Update cache """
     if stats == 'apps':
         collection = mongo_db['appstats_docs']
         last_hour_counter = apps_last_hour_counter
         last_day_counter = apps_last_day_counter
+        indexes = [apps_leaderboards, apps_names_index]
     elif stats == 'tasks':
         collection = mongo_db['appstats_tasks_docs']
         last_hour_counter = tasks_last_hour_counter
         last_day_counter = tasks_last_day_counter
-    # Ensuring indexes
-    collection.ensure_index([('app_id', ASCENDING), ('name', ASCENDING)],
-                            cache_for=3600)
-
-    hour_data = last_hour_counter.get_vals()
-    day_data = last_day_counter.get_vals()
-    hour_aver_data = calc_aver_data(hour_data, last_hour_counter.interval)
-    day_aver_data = calc_aver_data(day_data, last_day_counter.interval)
-
-    docs = data_to_flat_form(hour_data, hour_aver_data,
-                             day_data, day_aver_data,
-                             last_hour_counter.fields)
-    # Replace with new data
+        indexes = [tasks_leaderboards, tasks_names_index]
+    indexes = [index for index in indexes if index is not None]
+
+    docs_chunks = iter_cache_docs(last_hour_counter, last_day_counter,
+                                  indexes)
+    if incremental:
+        update_cache_incrementally(collection, docs_chunks)
+        return
+
+    # Replace with new data, reading counters chunk by chunk.
     collection.remove()
-    if docs:
-        collection.insert(docs.values())
+    # Digests of incremental updates don't match rewritten docs anymore
+    redis_db.delete('%s,cache_digests,%s' % (REDIS_PREFIX, collection.name))
+    for docs in docs_chunks:
+        collection.insert(docs)
+
+
+@manager.option('-i', '--interval', dest='interval', type=int,
+                default=1000, help='Flush interval in milliseconds')
+@manager.option('-p', '--port', dest='port', type=int, default=8125,
+                help='UDP port to listen on')
+@manager.option('-b', '--bind', dest='bind', default='0.0.0.0',
+                help='Address to listen on')
+@manager.option('-s', '--stats', required=True, dest='stats',
+                choices=['apps', 'tasks'], help='Statistics to receive')
+def ingest_udp(stats, bind, port, interval):
+    """
+    Receive stats datagrams of 'app_id|name|field:value[|field:value...]'
+    lines, aggregate them in memory and flush into counters.
+    """
+    if stats == 'apps':
+        counter_group = apps_counter_group
+    elif stats == 'tasks':
+        counter_group = tasks_counter_group
+    coalescer = StatsCoalescer(
+        lambda stats, _: counter_group.incrby_bulk(stats),
+        interval=interval,
+        max_entries=app.config['COALESCE_MAX_ENTRIES'],
+        queue_size=app.config['COALESCE_QUEUE_SIZE'],
+    )
+    try:
+        udp.serve((bind, port), lambda stats: coalescer.add(stats, None),
+                  histograms=HISTOGRAM_FIELDS)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        coalescer.close()
 
 
 def send_email(from_email, to_emails, content, subject):
@@ -123,6 +310,38 @@ def send_email(from_email, to_emails, content, subject):
         app.logger.exception(e)
 
 
+@manager.option('-p', '--processes', dest='processes', type=int,
+                default=None, help='Number of processes (CPUs by default)')
+@manager.option('-a', '--app-ids', dest='app_ids', nargs='*',
+                help='Apps to check (all by default)')
+@log_time_call(logging.INFO)
+def detect_anomalies(app_ids, processes):
+    """
+    Find anomalies of response time during the last day with seasonal
+    hybrid ESD test on six weeks of hourly data.
+    """
+    if not app_ids:
+        app_ids = [app_id for app_id, _ in app.config['APPLICATIONS']]
+    counter = apps_periodic_counters[-1]
+    end = datetime.utcnow()
+    pool = Pool(processes)
+    try:
+        for app_id in app_ids:
+            anomalies = find_app_anomalies(counter, app_id, end, pool=pool)
+            # Docs of online scorer are kept, docs without source
+            # are left by previous versions of this command
+            mongo_db.anomalies.remove({'app_id': app_id,
+                                       'source': {'$ne': SCORER_SOURCE}})
+            if anomalies:
+                mongo_db.anomalies.insert([
+                    {'name': name, 'anomalies': dates, 'app_id': app_id,
+                     'source': BATCH_SOURCE}
+                    for name, dates in anomalies.iteritems()])
+    finally:
+        pool.close()
+        pool.join()
+
+
 @manager.option('-m', '--mode', dest='mode',
                 choices=['console', 'email'], default='email',
                 help='Print results to console or send email')
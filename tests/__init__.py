@@ -0,0 +1,23 @@
+# encoding: utf-8
+import os
+import unittest
+
+from redis.client import StrictRedis
+from redis.exceptions import ConnectionError
+
+# Tests of redis scripts flush this db, so it must not be used otherwise
+TEST_REDIS_DB = int(os.environ.get('APPSTATS_TEST_REDIS_DB', 15))
+
+
+def get_test_redis():
+    """
+    Return empty redis db for tests, skip the test if redis isn't running.
+    """
+    db = StrictRedis(host=os.environ.get('APPSTATS_TEST_REDIS_HOST',
+                                         '127.0.0.1'),
+                     db=TEST_REDIS_DB)
+    try:
+        db.flushdb()
+    except ConnectionError:
+        raise unittest.SkipTest("Redis isn't running")
+    return db
@@ -0,0 +1,86 @@
+# encoding: utf-8
+import unittest
+
+import numpy as np
+
+from appstats.anomaly import t_ppf, norm_ppf, detect_anomalies
+
+
+def seasonal_series(days=14, period=24, seed=1):
+    """ Return hourly series of daily cycle with a little noise """
+    random = np.random.RandomState(seed)
+    hours = np.arange(days * period)
+    return (100 + 30 * np.sin(2 * np.pi * hours / period) +
+            random.normal(0, 2, len(hours)))
+
+
+class QuantilesTest(unittest.TestCase):
+
+    def test_norm_ppf(self):
+        for p, expected in [(0.5, 0.0), (0.975, 1.959964),
+                            (0.01, -2.326348), (0.99999, 4.264891)]:
+            self.assertAlmostEqual(float(norm_ppf(p)), expected, places=5)
+
+    def test_t_ppf(self):
+        # Quantiles of t-distribution tables
+        for p, df, expected in [(0.975, 3, 3.1824), (0.975, 5, 2.5706),
+                                (0.995, 5, 4.0321), (0.975, 10, 2.2281),
+                                (0.995, 10, 3.1693), (0.999, 20, 3.5518),
+                                (0.975, 30, 2.0423), (0.9995, 60, 3.4602),
+                                (0.975, 100, 1.9840), (0.99, 120, 2.3578),
+                                (0.975, 10 ** 6, 1.9600)]:
+            value = float(t_ppf(p, df))
+            # Expansion is less accurate for few degrees of freedom
+            tolerance = 0.002 if df < 10 else 0.0001
+            self.assertLess(abs(value - expected) / expected, tolerance,
+                            (p, df, value))
+
+    def test_t_ppf_arrays(self):
+        values = t_ppf(np.array([0.975, 0.975]), np.array([10, 100]))
+        self.assertEqual(values.shape, (2,))
+        self.assertGreater(values[0], values[1])
+
+
+class DetectAnomaliesTest(unittest.TestCase):
+
+    def test_spikes(self):
+        values = seasonal_series()
+        values[100] += 80
+        values[250] += 60
+        # Gap of missing docs
+        values[150:155] = np.nan
+        mask = detect_anomalies(values[np.newaxis])
+        self.assertEqual(np.flatnonzero(mask[0]).tolist(), [100, 250])
+
+    def test_no_anomalies(self):
+        mask = detect_anomalies(seasonal_series()[np.newaxis])
+        self.assertFalse(mask.any())
+
+    def test_drops_are_not_anomalies(self):
+        values = seasonal_series()
+        values[100] -= 80
+        self.assertFalse(detect_anomalies(values[np.newaxis]).any())
+
+    def test_rows(self):
+        spiked = seasonal_series(seed=3)
+        spiked[200] += 100
+        flat = np.full(len(spiked), 5.0)
+        missing = np.full(len(spiked), np.nan)
+        short = np.full(len(spiked), np.nan)
+        short[-30:] = 1.0
+        short[-5] = 100.0
+        mask = detect_anomalies(np.array([flat, spiked, missing, short]))
+        self.assertEqual(mask.shape, (4, len(spiked)))
+        self.assertFalse(mask[0].any())
+        self.assertEqual(np.flatnonzero(mask[1]).tolist(), [200])
+        # Rows without two periods of values aren't tested
+        self.assertFalse(mask[2].any())
+        self.assertFalse(mask[3].any())
+
+    def test_max_anoms(self):
+        values = seasonal_series()
+        spikes = range(10, 330, 20)
+        values[spikes] += 200
+        mask = detect_anomalies(values[np.newaxis], max_anoms=0.02)
+        self.assertEqual(mask.sum(), int(0.02 * len(values)))
+        self.assertTrue(set(np.flatnonzero(mask[0])) <= set(spikes))
@@ -0,0 +1,97 @@
+# encoding: utf-8
+import unittest
+
+from appstats.cardinality import CardinalityGuard
+from appstats.counter import CounterGroup, RingRollingCounter
+
+from . import get_test_redis
+
+
+class SpaceSavingTest(unittest.TestCase):
+
+    size = 3
+
+    def setUp(self):
+        self.db = get_test_redis()
+        self.keys = ['test,counts', 'test,errors']
+
+    def update(self, *weights):
+        args = [self.size, 60]
+        for name, weight in weights:
+            args.extend((name, weight))
+        return self.db.eval(CardinalityGuard.update_script,
+                            len(self.keys), *(self.keys + args))
+
+    def get_summary(self):
+        counts = dict(self.db.zrange(self.keys[0], 0, -1, withscores=True))
+        return counts, self.db.hgetall(self.keys[1])
+
+    def test_not_full(self):
+        self.assertEqual(self.update(('a', 1), ('b', 2)), [1, 1])
+        self.assertEqual(self.update(('a', 3)), [1])
+        self.assertEqual(self.get_summary(), ({'a': 4, 'b': 2}, {}))
+
+    def test_replace_least(self):
+        self.update(('a', 5), ('b', 3), ('c', 1))
+        # New name takes the least count as its error, so it's unsure
+        self.assertEqual(self.update(('d', 1)), [0])
+        counts, errors = self.get_summary()
+        self.assertEqual(counts, {'a': 5, 'b': 3, 'd': 2})
+        self.assertEqual(errors, {'d': '1'})
+        # Frequent name gets through once its guaranteed count is high
+        self.assertEqual(self.update(('d', 3)), [1])
+        self.assertEqual(self.update(('a', 1)), [1])
+        self.assertEqual(self.db.ttl(self.keys[0]), 60)
+
+
+class CardinalityGuardTest(unittest.TestCase):
+
+    max_names = 10
+
+    def setUp(self):
+        self.db = get_test_redis()
+        self.guard = CardinalityGuard(self.db, 'test', 'apps',
+                                      self.max_names)
+        self.counter = RingRollingCounter(db=self.db, fields=['NUMBER'],
+                                          redis_prefix='test')
+        self.group = CounterGroup(self.db, [self.counter], guard=self.guard)
+
+    def add(self, names, app_id='app'):
+        self.group.incrby_bulk({app_id: {name: {'NUMBER': number}
+                                         for name, number in names}})
+
+    def test_filter(self):
+        stats = {'app': {'a': {'NUMBER': 1}, 'b': {'NUMBER': 2}}}
+        self.assertEqual(self.guard.filter(stats), stats)
+        self.guard._passed['app'] = {'a'}
+        self.assertEqual(self.guard.filter(stats),
+                         {'app': {'a': {'NUMBER': 1},
+                                  '__other__': {'NUMBER': 2}}})
+
+    def test_bounded_names(self):
+        # Hot names come all the time, the tail changes
+        hot = [('hot%d' % i, 100) for i in xrange(5)]
+        for batch in xrange(30):
+            tail = [('tail%d_%d' % (batch, i), 1) for i in xrange(5)]
+            self.add(hot + tail)
+        self.add([('other', 1)], app_id='other_app')
+        counts = self.counter.get_vals()
+        names = counts['app']
+        self.assertLessEqual(len(names), self.max_names + 1)
+        self.assertIn('__other__', names)
+        for name, _ in hot:
+            self.assertIn(name, names)
+        # Nothing is lost, tail is counted under other name
+        self.assertEqual(sum(count['NUMBER'] for count in names.values()),
+                         30 * (500 + 5))
+        self.assertEqual(counts['other_app'], {'other': {'NUMBER': 1}})
+        self.assertIn('app', self.guard._passed)
+        self.assertNotIn('other_app', self.guard._passed)
+
+    def test_new_day(self):
+        self.add([('n%d' % i, 1) for i in xrange(self.max_names)])
+        self.assertIn('app', self.guard._passed)
+        self.guard._day = '19700101'
+        stats = {'app': {'new': {'NUMBER': 1}}}
+        # Summaries of the new day are empty
+        self.assertEqual(self.guard.filter(stats), stats)
@@ -0,0 +1,65 @@
+# encoding: utf-8
+import json
+import zlib
+import unittest
+
+import msgpack
+
+import appstats_client
+from appstats.codec import decode_stats, encode_compact, decompress
+from appstats.codec import JSON_CONTENT_TYPE, COMPACT_CONTENT_TYPE
+from appstats.codec import MAX_DECOMPRESSED_SIZE
+
+
+STATS = {u'app': {u'name': {u'NUMBER': 3, u'real_time': 1.5,
+                            u'real_time:hist': {u'3': 2, u'-7': 1}},
+                  u'náme2': {u'NUMBER': 1}},
+         u'app2': {u'name': {u'cpu_time': 0.25}}}
+
+
+def gzip(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class DecodeStatsTest(unittest.TestCase):
+
+    def test_json(self):
+        data = json.dumps(STATS)
+        self.assertEqual(decode_stats(data, JSON_CONTENT_TYPE), STATS)
+        self.assertEqual(decode_stats(gzip(data), JSON_CONTENT_TYPE,
+                                      'gzip'), STATS)
+
+    def test_compact(self):
+        for encode in (encode_compact, appstats_client.encode_compact):
+            data = encode(STATS)
+            self.assertEqual(decode_stats(data, COMPACT_CONTENT_TYPE), STATS)
+            self.assertEqual(decode_stats(gzip(data), COMPACT_CONTENT_TYPE,
+                                          'gzip'), STATS)
+
+    def test_compact_is_smaller(self):
+        stats = {'app': {'name%d' % i: {'NUMBER': i, 'real_time': 0.5}
+                         for i in xrange(100)}}
+        self.assertLess(len(encode_compact(stats)), len(json.dumps(stats)))
+
+    def test_malformed_compact(self):
+        for data in ['', 'not msgpack', msgpack.packb([['NUMBER']]),
+                     msgpack.packb([['NUMBER'], {'app': {'name': [5, 1]}}]),
+                     msgpack.packb([['NUMBER'], {'app': {'name': [0]}}]),
+                     msgpack.packb([['NUMBER'], {'app': ['name']}]),
+                     msgpack.packb(1)]:
+            with self.assertRaises(ValueError):
+                decode_stats(data, COMPACT_CONTENT_TYPE)
+
+    def test_encodings(self):
+        self.assertEqual(decompress('data', None), 'data')
+        self.assertEqual(decompress('data', 'identity'), 'data')
+        with self.assertRaises(ValueError):
+            decompress('data', 'br')
+        with self.assertRaises(ValueError):
+            decompress('not gzip', 'gzip')
+
+    def test_gzip_bomb(self):
+        data = gzip('\0' * (MAX_DECOMPRESSED_SIZE + 1))
+        with self.assertRaises(ValueError):
+            decompress(data, 'gzip')
@@ -0,0 +1,332 @@
+# encoding: utf-8
+import json
+import unittest
+from calendar import timegm
+from datetime import datetime, timedelta
+
+from pymongo.errors import AutoReconnect
+
+from appstats import counter as counter_module
+from appstats.counter import check_stats, migrate_to_interned_keys
+from appstats.counter import KeyInterner, RollingCounter, CounterGroup
+from appstats.counter import EpochPeriodicCounter, RingRollingCounter
+from appstats.counter import registry_scores
+
+from . import get_test_redis
+
+
+class CheckStatsTest(unittest.TestCase):
+
+    def check_counts(self, counts):
+        check_stats({'app': {'name': counts}})
+
+    def test_valid(self):
+        check_stats({})
+        self.check_counts({'NUMBER': 1, 'real_time': 0.5, 'cpu': 2L,
+                           'real_time:hist': {'-3': 1, '12': 2.0}})
+
+    def test_rejected_values(self):
+        for val in ['x', u'1', None, [1], (1,), True, False, {'1': 1},
+                    float('nan'), float('inf'), float('-inf')]:
+            with self.assertRaises(ValueError):
+                self.check_counts({'NUMBER': 1, 'real_time': val})
+
+    def test_rejected_json_values(self):
+        for data in ['{"real_time": "x"}', '{"NUMBER": null}',
+                     '{"NUMBER": [1]}', '{"NUMBER": true}',
+                     '{"NUMBER": NaN}', '{"NUMBER": Infinity}']:
+            with self.assertRaises(ValueError):
+                self.check_counts(json.loads(data))
+
+    def test_rejected_histograms(self):
+        for hist in [1, [], {'x': 1}, {'1': -1}, {'1': None},
+                     {'1': True}, {'1': float('nan')}]:
+            with self.assertRaises(ValueError):
+                self.check_counts({'NUMBER': 1, 'real_time:hist': hist})
+
+    def test_rejected_structure(self):
+        for stats in [[], {'app': []}, {'app': {'name': 1}},
+                      {1: {'name': {}}}, {'app': {1: {}}},
+                      {'app': {'name': {1: 1}}},
+                      {'a,b': {'name': {}}}, {'app': {'a,b': {}}}]:
+            with self.assertRaises(ValueError):
+                check_stats(stats)
+
+
+class KeyInternerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = get_test_redis()
+        self.interner = KeyInterner(self.db, 'test')
+
+    def count_script_calls(self, interner):
+        calls = []
+        script = interner._intern_script
+
+        def counted_script(*args, **kwargs):
+            calls.append(args)
+            return script(*args, **kwargs)
+        interner._intern_script = counted_script
+        return calls
+
+    def make_counter(self, interner, cls=RollingCounter):
+        return cls(db=self.db, fields=['NUMBER', 'real_time'],
+                   redis_prefix='test', use_lua=True, interner=interner)
+
+    def test_ids(self):
+        self.interner.intern('name', ['a', 'b', 'a'])
+        id_a = self.interner.get_id('name', 'a')
+        id_b = self.interner.get_id('name', 'b')
+        self.assertNotEqual(id_a, id_b)
+        # Ids are shared by processes and kept per kind
+        other = KeyInterner(self.db, 'test')
+        self.assertEqual(other.get_id('name', 'a'), id_a)
+        self.assertEqual(other.get_values('name', [id_b, id_a, '999']),
+                         ['b', 'a', None])
+        self.assertEqual(self.interner.get_id('field', 'a'), '1')
+
+    def test_intern_kwargs(self):
+        kwargs = self.interner.intern_kwargs(
+            {'app_id': 'app', 'name': 'name', 'field': 'NUMBER',
+             'interval': 60})
+        self.assertEqual(kwargs, {'app_id': '1', 'name': '1', 'field': '1',
+                                  'interval': 60})
+
+    def test_one_call_per_chunk(self):
+        stats = {'app': {'name%d' % i: {'NUMBER': 1, 'real_time': 0.5}
+                         for i in xrange(500)}}
+        CounterGroup(self.db, [self.make_counter(self.interner)],
+                     interner=self.interner).incrby_bulk(stats)
+        # Process with empty cache updates and reads all names
+        interner = KeyInterner(self.db, 'test')
+        calls = self.count_script_calls(interner)
+        counter = self.make_counter(interner)
+        counter.update()
+        counts = counter.get_vals()['app']
+        # Calls for app_ids, fields and the chunk of names
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(counts), 500)
+        self.assertEqual(counts['name7']['NUMBER'], 1)
+
+    def test_prune(self):
+        self.interner.intern('name', ['old', 'new'])
+        id_old = self.interner.get_id('name', 'old')
+        used_key = 'test,interned,name,used'
+        self.db.zincrby(used_key, 'old', -15 * 24 * 3600)
+        self.assertEqual(self.interner.prune(), 1)
+        self.assertIsNone(self.db.hget('test,interned,name', 'old'))
+        self.assertEqual(self.interner.get_values('name', [id_old]), [None])
+        self.assertIsNotNone(self.db.hget('test,interned,name', 'new'))
+        # Pruned value gets a new id in processes which don't cache it
+        other = KeyInterner(self.db, 'test')
+        self.assertNotEqual(other.get_id('name', 'old'), id_old)
+
+    def test_cache_generations(self):
+        self.interner.intern('name', ['a'])
+        calls = self.count_script_calls(self.interner)
+        self.interner._rotated -= KeyInterner.CACHE_GENERATION
+        # Cached id is moved into new generation and marked as used
+        self.interner.intern('name', ['a'])
+        self.interner.intern('name', ['a'])
+        self.assertEqual(len(calls), 1)
+        self.interner._rotated -= KeyInterner.CACHE_GENERATION
+        self.interner._rotate()
+        self.interner._rotated -= KeyInterner.CACHE_GENERATION
+        self.interner._rotate()
+        self.assertEqual(self.interner._ids['name'], {})
+        self.assertEqual(self.interner._old_ids['name'], {})
+
+
+class MigrateToInternedKeysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = get_test_redis()
+
+    def make_counter(self, interner=None):
+        return RollingCounter(db=self.db, fields=['NUMBER', 'real_time'],
+                              redis_prefix='test', use_lua=True,
+                              interner=interner)
+
+    def test_migrate(self):
+        stats = {'app': {'name1': {'NUMBER': 2, 'real_time': 0.5},
+                         'name2': {'NUMBER': 1}},
+                 'app2': {'name1': {'NUMBER': 3}}}
+        self.make_counter().incrby_bulk(stats)
+        plain_keys = set(self.db.keys('test_apps,*'))
+        interner = KeyInterner(self.db, 'test')
+        counter = self.make_counter(interner)
+        migrate_to_interned_keys(counter, chunk_size=1)
+        keys = set(self.db.keys('test_apps,*'))
+        # Only the registry of app_ids has no app_id, name or field
+        app_ids_key = counter._make_plain_key(counter.app_ids_key_format)
+        self.assertEqual(plain_keys & keys, {app_ids_key})
+        self.assertTrue(plain_keys)
+        for key in keys:
+            self.assertNotIn('name', key.replace('names_set', ''))
+        vals = counter.get_vals()
+        self.assertEqual(vals['app']['name1']['NUMBER'], 2)
+        self.assertEqual(vals['app']['name1']['real_time'], 0.5)
+        self.assertEqual(vals['app']['name2']['NUMBER'], 1)
+        self.assertEqual(vals['app2']['name1']['NUMBER'], 3)
+
+
+class FakeCollection(object):
+    """ Collection keeping inserted docs in a list """
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = []
+
+    def insert_many(self, docs, ordered=True):
+        self.docs.extend(dict(doc) for doc in docs)
+
+    def remove(self, spec):
+        pass
+
+
+class FakeMongo(dict):
+
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection(name)
+        return collection
+
+
+class EpochPeriodicCounterTest(unittest.TestCase):
+
+    # Start of 1 minute epoch
+    start = datetime(2026, 1, 1, 12, 30)
+
+    def setUp(self):
+        self.db = get_test_redis()
+        self.counter = EpochPeriodicCounter(
+            60, self.db, FakeMongo(), ['NUMBER', 'real_time'], 'test',
+            histograms=['real_time'])
+        self.docs = self.counter.collection.docs
+
+    def add(self, seconds, stats):
+        now = timegm(self.start.utctimetuple()) + seconds
+        pl = self.db.pipeline()
+        apps_scores, names_scores = registry_scores(stats, now)
+        self.counter._queue_incrby_bulk(pl, stats, now,
+                                        (apps_scores, names_scores))
+        pl.execute()
+
+    def update(self, seconds):
+        now = self.start + timedelta(seconds=seconds)
+
+        class FrozenDatetime(datetime):
+            @classmethod
+            def utcnow(cls):
+                return now
+        counter_module.datetime = FrozenDatetime
+        try:
+            self.counter.update()
+        finally:
+            counter_module.datetime = datetime
+
+    def test_close_delay(self):
+        self.add(10, {'app': {'name': {'NUMBER': 2, 'real_time': 0.5,
+                                       'real_time:hist': {'3': 2}}}})
+        self.add(59, {'app': {'name': {'NUMBER': 1}}})
+        self.update(61)
+        self.assertEqual(self.docs, [])
+        # Hosts with clocks behind still write into the epoch
+        self.add(62 - EpochPeriodicCounter.CLOSE_DELAY,
+                 {'app': {'name': {'NUMBER': 1}}})
+        self.update(65)
+        self.assertEqual(len(self.docs), 1)
+        doc = self.docs[0]
+        self.assertEqual(doc['date'], self.start + timedelta(minutes=1))
+        self.assertEqual(doc['NUMBER'], 4)
+        self.assertEqual(doc['real_time'], 0.5)
+        self.assertEqual(doc['real_time:hist'], {'3': 2})
+        self.assertEqual(self.db.keys('test_apps,periodic,60,*,app,*'), [])
+
+    def test_late_write(self):
+        self.add(10, {'app': {'name': {'NUMBER': 2}}})
+        self.update(70)
+        # Write of the closed epoch is dropped, not stored as second doc
+        self.add(30, {'app': {'name': {'NUMBER': 5}}})
+        self.add(80, {'app': {'name': {'NUMBER': 1}}})
+        self.update(130)
+        self.assertEqual([(doc['date'].minute, doc['NUMBER'])
+                          for doc in self.docs], [(31, 2), (32, 1)])
+        epochs_key = self.counter._make_key(self.counter.epochs_key_format)
+        self.assertEqual(self.db.zcard(epochs_key), 0)
+
+    def test_failed_insert(self):
+        self.add(10, {'app': {'name': {'NUMBER': 2}}})
+        insert_many = self.counter.collection.insert_many
+
+        def failing_insert(docs, ordered=True):
+            raise AutoReconnect()
+        self.counter.collection.insert_many = failing_insert
+        self.update(70)
+        # Snapshot is read again, increments written after it are late
+        self.add(20, {'app': {'name': {'NUMBER': 1}}})
+        self.counter.collection.insert_many = insert_many
+        self.update(71)
+        self.assertEqual([doc['NUMBER'] for doc in self.docs], [2])
+        self.update(72)
+        self.assertEqual([doc['NUMBER'] for doc in self.docs], [2])
+        self.assertEqual(self.db.keys('test_apps,periodic,60,*,app,*'), [])
+
+
+class RingRollingCounterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = get_test_redis()
+        self.counter = RingRollingCounter(db=self.db,
+                                          fields=['NUMBER', 'real_time'],
+                                          redis_prefix='test')
+
+    def test_incrby_bulk_in_pipeline(self):
+        stats = {'app': {'name': {'NUMBER': 2, 'real_time': 0.5},
+                         'name2': {'NUMBER': 1}}}
+        now = timegm(datetime.utcnow().utctimetuple())
+        pl = self.db.pipeline()
+        self.counter._queue_incrby_bulk(pl, stats,
+                                        now, registry_scores(stats, now))
+        # Pipeline with registered scripts checks them before execution
+        self.assertFalse(pl.scripts)
+        pl.execute()
+        self.counter.incrby('app', 'name', 'NUMBER', 3)
+        counts = self.counter.get_vals()['app']
+        self.assertEqual(counts['name']['NUMBER'], 5)
+        self.assertEqual(counts['name']['real_time'], 0.5)
+        self.assertEqual(counts['name2']['NUMBER'], 1)
+
+    def write(self, ts, increment):
+        stats = {'app': {'name': {'NUMBER': increment}}}
+        pl = self.db.pipeline()
+        self.counter._queue_incrby_bulk(pl, stats, ts,
+                                        registry_scores(stats, ts))
+        pl.execute()
+
+    def read(self, ts):
+        key = self.counter._make_key(self.counter.ring_key_format,
+                                     app_id='app', name='name',
+                                     field='NUMBER')
+        return self.counter._read_count(iter([self.db.hgetall(key)]), ts)
+
+    def test_read_count_wrap_around(self):
+        ring_size = self.counter._ring_size
+        # Last part of the ring is written just before wrap-around
+        start = (100 * ring_size + ring_size - 1) * 60
+        self.write(start, 1)
+        self.write(start + 60, 2)
+        self.write(start + 120, 4)
+        self.assertEqual(self.read(start + 150), 7)
+        # Oldest part is taken proportionally after an hour
+        self.assertEqual(self.read(start + 3630), 6.5)
+        self.assertEqual(self.read(start + 3660), 6)
+        self.assertEqual(self.read(start + 3720), 4)
+        self.assertEqual(self.read(start + 3780), 0)
+
+    def test_outdated_parts_are_reset(self):
+        ring_size = self.counter._ring_size
+        start = 100 * ring_size * 60
+        self.write(start, 1)
+        # The same part a whole ring later
+        self.write(start + ring_size * 60, 2)
+        self.assertEqual(self.read(start + ring_size * 60), 2)
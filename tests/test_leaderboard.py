@@ -0,0 +1,55 @@
+# encoding: utf-8
+import unittest
+
+from appstats.leaderboard import Leaderboards
+
+from . import get_test_redis
+
+
+class LeaderboardsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = get_test_redis()
+        self.leaderboards = Leaderboards(self.db, 'test', 'apps', ['NUMBER'])
+
+    def add(self, *docs):
+        self.leaderboards.add([dict(app_id='app', NUMBER_hour=number,
+                                    name=name)
+                               for name, number in docs])
+
+    def test_replace(self):
+        self.add(('a', 1), ('b', 3), ('c', 2))
+        self.leaderboards.replace()
+        self.assertEqual(self.leaderboards.get_top('app', 'NUMBER_hour', 2),
+                         ['b', 'c'])
+        key = self.leaderboards._make_key('app', 'NUMBER_hour')
+        self.assertEqual(self.db.ttl(key), -1)
+        # Rebuilt leaderboard replaces the previous one
+        self.add(('a', 5))
+        self.leaderboards.replace()
+        self.assertEqual(self.leaderboards.get_top('app', 'NUMBER_hour', 5),
+                         ['a'])
+        # Leaderboards without docs are deleted
+        self.leaderboards.replace()
+        self.assertEqual(self.db.keys('test,leaderboard,*'), [])
+
+    def test_expired_tmp_key(self):
+        self.add(('a', 1))
+        self.leaderboards.replace()
+        self.add(('b', 1))
+        self.db.delete(self.leaderboards._make_tmp_key('app', 'NUMBER_hour'))
+        self.leaderboards.replace()
+        self.assertEqual(self.leaderboards.get_top('app', 'NUMBER_hour', 5),
+                         [])
+
+    def test_feed(self):
+        self.add(('a', 1), ('b', 3))
+        self.leaderboards.replace()
+        pl = self.db.pipeline()
+        self.leaderboards._queue_incrby_bulk(
+            pl, {'app': {'a': {'NUMBER': 5}, 'c': {'NUMBER': 1}}}, 0, None)
+        pl.execute()
+        self.assertEqual(self.leaderboards.get_top('app', 'NUMBER_hour', 5),
+                         ['a', 'b', 'c'])
+        self.assertEqual(self.leaderboards.get_top('app', 'NUMBER_day', 5),
+                         ['a', 'c'])
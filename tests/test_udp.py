@@ -0,0 +1,56 @@
+# encoding: utf-8
+import unittest
+
+from appstats.udp import parse_line, parse_datagram
+from appstats.counter import check_stats
+from appstats.util import hist_bucket
+
+
+class ParseLineTest(unittest.TestCase):
+
+    def test_line(self):
+        self.assertEqual(parse_line('app|name|real_time:0.5|NUMBER:2\n'),
+                         (u'app', u'name',
+                          {u'real_time': 0.5, u'NUMBER': 2.0}))
+        # Single observation by default, colons in field keys
+        self.assertEqual(parse_line('app|name|sql:duration:0.1'),
+                         (u'app', u'name',
+                          {u'sql:duration': 0.1, u'NUMBER': 1.0}))
+        self.assertEqual(parse_line('app|náme|cpu:1|cpu:2'),
+                         (u'app', u'n\xe1me', {u'cpu': 3.0, u'NUMBER': 1.0}))
+
+    def test_histograms(self):
+        app_id, name, counts = parse_line('app|name|real_time:0.5',
+                                          histograms=['real_time'])
+        self.assertEqual(counts[u'real_time:hist'], {hist_bucket(0.5): 1})
+
+    def test_malformed(self):
+        for line in ['', 'app|name', 'app||NUMBER:1', '|name|NUMBER:1',
+                     'a,b|name|NUMBER:1', 'app|a,b|NUMBER:1',
+                     'app|name|NUMBER', 'app|name|NUMBER:x',
+                     'app|name|:1', 'app|name|NUMBER:nan',
+                     'app|name|NUMBER:inf', 'app|name|real_time:hist:1',
+                     'app|name|\xff:1']:
+            self.assertIsNone(parse_line(line), line)
+
+
+class ParseDatagramTest(unittest.TestCase):
+
+    def test_datagram(self):
+        data = ('app|a|NUMBER:1|real_time:0.5\n'
+                'app|a|real_time:0.25\n'
+                '\n'
+                'broken line\n'
+                'app|b|NUMBER:x\n'
+                'app2|a|cpu:1\n')
+        stats, malformed = parse_datagram(data)
+        self.assertEqual(malformed, 2)
+        self.assertEqual(stats, {
+            u'app': {u'a': {u'NUMBER': 2.0, u'real_time': 0.75}},
+            u'app2': {u'a': {u'cpu': 1.0, u'NUMBER': 1.0}},
+        })
+        check_stats(stats)
+
+    def test_empty(self):
+        self.assertEqual(parse_datagram(''), ({}, 0))
+        self.assertEqual(parse_datagram('garbage'), ({}, 1))
@@ -0,0 +1,154 @@
+# encoding: utf-8
+import math
+import unittest
+from itertools import izip
+
+import appstats_client
+from appstats.util import make_columnar_series, downsample_lttb
+from appstats.util import hist_bucket, hist_quantiles, merge_hist
+from appstats.util import HIST_GAMMA, HIST_MIN_VALUE
+
+
+def make_series(num_points, func, step=60000):
+    return [[i * step, func(i)] for i in xrange(num_points)]
+
+
+def restore_dates(timestamps):
+    dates = timestamps[:1]
+    for delta in timestamps[1:]:
+        dates.append(dates[-1] + delta)
+    return dates
+
+
+class DownsampleLttbTest(unittest.TestCase):
+
+    def test_short_series(self):
+        points = make_series(10, float)
+        self.assertIs(downsample_lttb(points, 10), points)
+        self.assertIs(downsample_lttb(points, 2), points)
+
+    def test_max_points(self):
+        points = make_series(1000, lambda i: math.sin(i / 10.0))
+        for max_points in (3, 10, 100, 999):
+            selected = downsample_lttb(points, max_points)
+            self.assertEqual(len(selected), max_points)
+            self.assertEqual(selected[0], points[0])
+            self.assertEqual(selected[-1], points[-1])
+            dates = [point[0] for point in selected]
+            self.assertEqual(dates, sorted(set(dates)))
+
+    def test_peaks(self):
+        points = make_series(1000, lambda i: 1.0)
+        points[123][1] = 50.0
+        points[456][1] = -50.0
+        selected = downsample_lttb(points, 20)
+        self.assertIn(points[123], selected)
+        self.assertIn(points[456], selected)
+
+    def test_missing_values(self):
+        points = make_series(100, lambda i: None if i % 3 else 1.0)
+        self.assertEqual(len(downsample_lttb(points, 10)), 10)
+
+    def test_keep(self):
+        points = make_series(1000, lambda i: 1.0)
+        keep = {points[5][0], points[500][0]}
+        selected = downsample_lttb(points, 10, keep)
+        self.assertIn(points[5], selected)
+        self.assertIn(points[500], selected)
+        self.assertEqual(selected, sorted(selected))
+
+
+class ColumnarSeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.num_data = make_series(1440, lambda i: math.sin(i / 50.0) + 2)
+        self.time_data = [make_series(1440, lambda i, k=k: (i * k) % 17)
+                          for k in xrange(1, 7)]
+
+    def test_columns_share_dates(self):
+        series = make_columnar_series(self.num_data[:3],
+                                      [row[:3] for row in self.time_data],
+                                      [])
+        self.assertEqual(series['timestamps'], [0, 60000, 60000])
+        self.assertEqual(len(series['rate']), 3)
+        self.assertEqual(len(series['timings']), 6)
+        for column in series['timings']:
+            self.assertEqual(len(column), 3)
+
+    def test_point_budget(self):
+        for max_points in (500, 100, 10):
+            series = make_columnar_series(self.num_data, self.time_data,
+                                          [], max_points)
+            self.assertEqual(len(series['timestamps']), max_points)
+            self.assertEqual(len(series['rate']), max_points)
+            for column in series['timings']:
+                self.assertEqual(len(column), max_points)
+
+    def test_budget_includes_anomalies(self):
+        anomalies = [10 * 60000, 20 * 60000, 700 * 60000]
+        series = make_columnar_series(self.num_data, self.time_data,
+                                      anomalies, 100)
+        dates = restore_dates(series['timestamps'])
+        self.assertLessEqual(len(dates), 100)
+        for date in anomalies:
+            self.assertIn(date, dates)
+
+    def test_peak_of_any_series_is_kept(self):
+        time_data = [make_series(1440, lambda i: 1.0) for _ in xrange(3)]
+        time_data[2][777][1] = 1000.0
+        series = make_columnar_series(self.num_data, time_data, [], 50)
+        dates = restore_dates(series['timestamps'])
+        self.assertIn(777 * 60000, dates)
+        self.assertIn(1000.0, series['timings'][2])
+
+    def test_missing_values(self):
+        self.num_data[5][1] = None
+        for row in self.time_data:
+            row[5][1] = None
+        series = make_columnar_series(self.num_data, self.time_data, [])
+        self.assertIsNone(series['rate'][5])
+        self.assertIsNone(series['timings'][0][5])
+
+
+class HistogramTest(unittest.TestCase):
+
+    def make_hist(self, values):
+        hist = {}
+        for value in values:
+            bucket = hist_bucket(value)
+            hist[bucket] = hist.get(bucket, 0) + 1
+        return hist
+
+    def test_buckets(self):
+        # Bucket i holds values in (HIST_GAMMA ** (i - 1), HIST_GAMMA ** i]
+        self.assertEqual(hist_bucket(1.0), '0')
+        self.assertEqual(hist_bucket(HIST_GAMMA ** 0.5), '1')
+        self.assertEqual(hist_bucket(HIST_GAMMA ** 1.5), '2')
+        self.assertEqual(hist_bucket(HIST_GAMMA ** -0.5), '0')
+        self.assertEqual(hist_bucket(HIST_GAMMA ** -1.5), '-1')
+        self.assertEqual(hist_bucket(0), hist_bucket(HIST_MIN_VALUE))
+        # Client makes the same buckets
+        for value in (0.0, 0.001, 0.5, 1.0, 3.3, 1000.0):
+            self.assertEqual(appstats_client.hist_bucket(value),
+                             hist_bucket(value))
+
+    def test_quantiles(self):
+        values = [i / 1000.0 for i in xrange(1, 1001)]
+        quantiles = hist_quantiles(self.make_hist(values),
+                                   (0.5, 0.95, 0.99, 1.0))
+        for quantile, expected in izip(quantiles, (0.5, 0.95, 0.99, 1.0)):
+            self.assertLess(abs(quantile - expected) / expected,
+                            (HIST_GAMMA - 1) / 2 + 0.001)
+
+    def test_empty(self):
+        self.assertEqual(hist_quantiles({}, (0.5, 0.99)), [None, None])
+        self.assertEqual(hist_quantiles({'1': 0}, (0.5,)), [None])
+
+    def test_merge(self):
+        values = [i / 100.0 for i in xrange(1, 501)]
+        merged = {}
+        for part in (values[:100], values[100:350], values[350:]):
+            merge_hist(merged, self.make_hist(part))
+        self.assertEqual(merged, self.make_hist(values))
+        self.assertEqual(hist_quantiles(merged, (0.5, 0.9)),
+                         hist_quantiles(self.make_hist(values), (0.5, 0.9)))